@@ -1,80 +1,133 @@
 import logging
 import asyncio
+import functools
+import hashlib
 import random
+import socket
 import os
 import time
 from datetime import datetime, timedelta
-from pyrogram.types import Message, InlineKeyboardButton, InlineKeyboardMarkup, CallbackQuery
-from pyrogram import filters, Client, errors, enums
-from pyrogram.errors import UserNotParticipant, FloodWait
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.triggers.interval import IntervalTrigger
+from pyrogram.types import Message, InlineKeyboardButton, InlineKeyboardMarkup, CallbackQuery, ChatMemberUpdated
+from pyrogram import filters, Client, errors, enums, idle
+from pyrogram.errors import UserNotParticipant
+from pyrogram.session import Session
 import pytz
 
 from database import (
-    add_user, add_group, all_users, all_groups, users, remove_user,
-    add_onboarding_user, get_onboarding_user, update_onboarding_stage,
+    register_join, register_joins, add_user, create_onboarding_user, stats_snapshot, refresh_stats,
+    get_onboarding_user, update_onboarding_stage,
     mark_follow_up_sent, mark_setup_completed, mark_account_verified,
-    get_users_for_follow_up, is_user_in_onboarding, already_onboarding,
-    reset_onboarding, get_whatsapp_link, set_whatsapp_link
-)
-from configs import cfg
-
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler()
-    ]
+    is_user_in_onboarding, already_onboarding,
+    reset_onboarding, get_whatsapp_link, set_whatsapp_link, ping,
+    ensure_indexes, ensure_shard_layout, flush_onboarding_updates, load_settings, refresh_settings,
+    outbox_backlog, heartbeat_sender, remove_sender
 )
+from configs import cfg, primary_tenant, load_extra_tenants
+from tenants import tenant_local, run_in_tenant, get_tenant
+from rate_limiter import SendScheduler
+from broadcast import BroadcastEngine
+from follow_ups import FollowUpScheduler
+from delivery import DeliveryQueue, outbox_message
+from sharding import ShardLeases
+from workers import WorkerPool, consume
+from session_storage import MongoSessionStorage
+from membership import MembershipCache
+from invite_links import InviteLinkPool
+import metrics
+from logging_setup import setup_logging
+
+# Configure logging (written by a background thread, see logging_setup)
+setup_logging(cfg.LOG_LEVEL, cfg.LOG_FORMAT == "json", cfg.LOG_RATE_LIMIT)
 
 logger = logging.getLogger(__name__)
 
-# Create unique session name for different environments
-session_name = f"graceboy_bot_{os.getenv('RAILWAY_ENVIRONMENT', 'local')}_{hash(cfg.BOT_TOKEN) % 10000}"
+def session_name() -> str:
+    """Session name for this bot and process, stable across restarts"""
+    # Derived from the token with a real hash; hash() of a str changes every run
+    token_digest = hashlib.sha256(cfg.BOT_TOKEN.encode()).hexdigest()[:12]
+    name = f"graceboy_bot_{os.getenv('RAILWAY_ENVIRONMENT', 'local')}_{token_digest}"
+    if cfg.WORKER_ROLE == "worker":
+        # Each worker needs its own authorisation. With Mongo storage the
+        # number is a leased slot appended by MongoSessionStorage; with file
+        # storage only local workers (WORKER_INDEX) get a session file.
+        name += "_worker"
+        if cfg.SESSION_STORAGE != "mongo":
+            name += os.getenv("WORKER_INDEX", "")
+    return name
 
-# Ensure sessions directory exists and is writable
-import os
-sessions_dir = "/tmp/sessions"
-os.makedirs(sessions_dir, exist_ok=True)
-
-# Initialize bot client with improved connection settings
-app = Client(
-    session_name,
-    api_id=cfg.API_ID,
-    api_hash=cfg.API_HASH,
-    bot_token=cfg.BOT_TOKEN,
-    workers=25,  # Reduced workers to prevent overwhelming connections
-    sleep_threshold=60,  # Shorter sleep threshold
-    workdir=sessions_dir,  # Store session files in /tmp
-    in_memory=False,  # Use persistent sessions
-    max_concurrent_transmissions=10  # Limit concurrent transmissions
-)
+class BotClient(Client):
+    """Client that records every FloodWait (bot_flood_wait_seconds)
+
+    Pyrogram sleeps through FloodWaits up to sleep_threshold inside the session
+    without raising them. Here the session is asked to raise them all, so each
+    one is recorded before sleeping (up to the same threshold) or re-raising.
+    """
+
+    async def invoke(self, query, retries=Session.MAX_RETRIES, timeout=Session.WAIT_TIMEOUT, sleep_threshold=None):
+        threshold = self.sleep_threshold if sleep_threshold is None else sleep_threshold
+        method = ".".join(query.QUALNAME.split(".")[1:])
+        while True:
+            try:
+                return await super().invoke(query, retries, timeout, sleep_threshold=0)
+            except errors.FloodWait as e:
+                metrics.flood_waits.observe(e.value, tenant=cfg.BOT_OWNER, method=method)
+                if e.value > threshold:
+                    raise
+                logger.warning("Waiting %ss before calling %s again (FloodWait)", e.value, method)
+                await asyncio.sleep(e.value)
+
+def create_client():
+    """Build the pyrogram client for the current tenant"""
+    worker = cfg.WORKER_ROLE == "worker"
+    name = session_name()
+    
+    if cfg.SESSION_STORAGE == "mongo":
+        storage = MongoSessionStorage(name, lease_seconds=cfg.SHARD_LEASE_SECONDS if worker else None)
+    else:
+        # Ensure sessions directory exists and is writable
+        os.makedirs(cfg.SESSIONS_DIR, exist_ok=True)
+        storage = None
+    
+    # Initialize bot client with improved connection settings
+    return BotClient(
+        name,
+        api_id=cfg.API_ID,
+        api_hash=cfg.API_HASH,
+        bot_token=cfg.BOT_TOKEN,
+        workers=25,  # Reduced workers to prevent overwhelming connections
+        sleep_threshold=60,  # Shorter sleep threshold
+        workdir=cfg.SESSIONS_DIR,  # Where "file" session storage keeps its files
+        storage=storage,  # Session kept in MongoDB (None: a file in workdir)
+        in_memory=worker and storage is None and os.getenv("WORKER_INDEX") is None,  # Remote workers can't share a session file
+        no_updates=worker,  # Only one process receives the update stream
+        max_concurrent_transmissions=10  # Limit concurrent transmissions
+    )
 
-# Initialize scheduler with proper job settings
-scheduler = AsyncIOScheduler()
+# Each tenant (BOT_OWNER) has its own client; handlers below are registered on
+# the primary tenant's client and copied to the others at startup
+app = tenant_local(create_client)
 
-# Rate limiting for API calls
-last_api_call = {}
-API_CALL_DELAY = 1.0  # Minimum delay between API calls
+# Rate limiting for API calls: global and per-chat token buckets. The global
+# budget belongs to the bot token and is split over the processes using it
+# (see refresh_send_share)
+send_scheduler = tenant_local(lambda: SendScheduler(
+    global_rate=cfg.GLOBAL_SEND_RATE,
+    per_chat_rate=cfg.PER_CHAT_SEND_RATE,
+    global_burst=cfg.GLOBAL_SEND_BURST,
+    per_chat_burst=cfg.PER_CHAT_SEND_BURST
+))
 
 async def rate_limited_send(func, *args, **kwargs):
     """Apply rate limiting to API calls with exponential backoff"""
-    current_time = time.time()
-    if 'last_call' not in rate_limited_send.__dict__:
-        rate_limited_send.last_call = 0
-    
-    time_since_last = current_time - rate_limited_send.last_call
-    if time_since_last < API_CALL_DELAY:
-        await asyncio.sleep(API_CALL_DELAY - time_since_last)
+    chat_id = args[0] if args else kwargs.get("chat_id")
     
     max_retries = 5
     base_delay = 2
     
     for attempt in range(max_retries):
+        with metrics.send_wait.time(tenant=cfg.BOT_OWNER):
+            await send_scheduler.acquire(chat_id)
         try:
-            rate_limited_send.last_call = time.time()
             return await func(*args, **kwargs)
         except (errors.FloodWait, ConnectionError, OSError) as e:
             if attempt == max_retries - 1:
@@ -85,11 +138,64 @@ async def rate_limited_send(func, *args, **kwargs):
             else:
                 delay = base_delay * (2 ** attempt) + random.uniform(0, 1)
             
-            logger.warning(f"Connection error (attempt {attempt + 1}/{max_retries}): {e}. Retrying in {delay:.2f}s")
+            logger.warning("Connection error (attempt %s/%s): %s. Retrying in %.2fs", attempt + 1, max_retries, e, delay)
             await asyncio.sleep(delay)
     
     raise Exception(f"Failed after {max_retries} attempts")
 
+# Identifies this process among the processes sending with a bot token
+SENDER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+async def refresh_send_share():
+    """Give this process an equal share of the bot token's global send rate
+
+    Every process sending with the token (update handler, local and remote
+    workers) heartbeats, and the global bucket is set to GLOBAL_SEND_RATE
+    divided by the number alive, so together they stay under Telegram's limit.
+    """
+    senders = max(await heartbeat_sender(SENDER_ID, cfg.SHARD_LEASE_SECONDS), 1)
+    send_scheduler.set_global_rate(cfg.GLOBAL_SEND_RATE / senders, max(cfg.GLOBAL_SEND_BURST / senders, 1))
+
+# Seconds between background refreshes of the /users stats
+STATS_REFRESH_SECONDS = 60
+# Seconds between checks for settings changed by another process
+SETTINGS_REFRESH_SECONDS = 30
+# Seconds that channel membership answers are trusted (positive / negative)
+MEMBERSHIP_TTL = 600
+MEMBERSHIP_NEGATIVE_TTL = 30
+
+# Channel membership seen in approvals, chat_member updates and get_chat_member calls
+membership_cache = tenant_local(lambda: MembershipCache(MEMBERSHIP_TTL, MEMBERSHIP_NEGATIVE_TTL))
+
+# Reusable channel invite links handed to non-members on /start
+INVITE_LINK_POOL_SIZE = 5
+INVITE_LINK_TTL = 24 * 60 * 60
+INVITE_LINK_REFRESH_SECONDS = 15 * 60
+invite_link_pool = tenant_local(lambda: InviteLinkPool(app, cfg.CHID, INVITE_LINK_POOL_SIZE, INVITE_LINK_TTL))
+
+# Background worker processes started by main() when WORKER_PROCESSES is set
+worker_pool = None
+
+def notify_workers(event: str, **data):
+    """Tell the background worker processes (if any) about new work"""
+    if worker_pool is not None:
+        worker_pool.notify(cfg.BOT_OWNER, event, **data)
+
+def runs_background() -> bool:
+    """Whether this process runs the background work itself"""
+    if cfg.WORKER_ROLE == "all":
+        return worker_pool is None
+    return cfg.WORKER_ROLE == "worker"
+
+# This process's share of the background work (follow-ups and broadcasts), by user_id shard
+shard_leases = tenant_local(lambda: ShardLeases(cfg.SHARD_COUNT, cfg.SHARD_LEASE_SECONDS))
+
+# Broadcast engine for /bcast and /fcast
+broadcast_engine = tenant_local(lambda: BroadcastEngine(app, rate_limited_send, shard_leases, workers=cfg.BROADCAST_WORKERS))
+
+# Admin commands are checked against the SUDO list of the tenant receiving the update
+sudo_filter = filters.create(lambda _, __, m: bool(m.from_user) and m.from_user.id in cfg.SUDO)
+
 #━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━ Debug Handler (Priority) ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 
 @app.on_message(filters.command("test") & filters.private)
@@ -98,9 +204,9 @@ async def test_admin_priority(_, m: Message):
     user_id = m.from_user.id
     first_name = m.from_user.first_name or "Friend"
     
-    logger.info(f"🔍 PRIORITY: /test command from user {user_id}")
-    logger.info(f"🔍 PRIORITY: cfg.SUDO contains: {cfg.SUDO}")
-    logger.info(f"🔍 PRIORITY: Is {user_id} in SUDO? {user_id in cfg.SUDO}")
+    logger.info("🔍 PRIORITY: /test command from user %s", user_id)
+    logger.info("🔍 PRIORITY: cfg.SUDO contains: %s", cfg.SUDO)
+    logger.info("🔍 PRIORITY: Is %s in SUDO? %s", user_id, user_id in cfg.SUDO)
     
     try:
         if user_id in cfg.SUDO:
@@ -108,11 +214,11 @@ async def test_admin_priority(_, m: Message):
             
             # Test welcome message functionality
             try:
-                logger.info(f"🔍 DEBUG: Testing welcome message for admin {user_id}")
+                logger.debug("Testing welcome message for admin %s", user_id)
                 await send_welcome_message(user_id, first_name)
                 await m.reply_text("✅ Welcome message test: SUCCESS")
             except Exception as e:
-                logger.error(f"🔍 DEBUG: Welcome message test failed: {e}")
+                logger.error("Welcome message test failed: %s", e)
                 await m.reply_text(f"❌ Welcome message test: FAILED - {e}")
                 
         else:
@@ -120,18 +226,18 @@ async def test_admin_priority(_, m: Message):
             
             # Test welcome message for regular user
             try:
-                logger.info(f"🔍 DEBUG: Testing welcome message for user {user_id}")
+                logger.debug("Testing welcome message for user %s", user_id)
                 await send_welcome_message(user_id, first_name)
                 await m.reply_text("✅ Welcome message test: SUCCESS")
             except Exception as e:
-                logger.error(f"🔍 DEBUG: Welcome message test failed: {e}")
+                logger.error("Welcome message test failed: %s", e)
                 await m.reply_text(f"❌ Welcome message test: FAILED - {e}")
                 
     except Exception as e:
-        logger.error(f"Error in test command: {e}")
+        logger.error("Error in test command: %s", e)
         await m.reply_text(f"Error: {e}")
 
-@app.on_message(filters.command("resetonboarding") & filters.user(cfg.SUDO))
+@app.on_message(filters.command("resetonboarding") & sudo_filter)
 async def reset_onboarding_command(_, m: Message):
     """Reset onboarding for a user (admin only)"""
     user_id = m.from_user.id
@@ -144,92 +250,119 @@ async def reset_onboarding_command(_, m: Message):
         else:
             target_user_id = user_id
             
-        if already_onboarding(target_user_id):
-            reset_onboarding(target_user_id)
+        if await already_onboarding(target_user_id):
+            await reset_onboarding(target_user_id)
             await m.reply_text(f"✅ Reset onboarding for user {target_user_id}")
-            logger.info(f"Admin {user_id} reset onboarding for user {target_user_id}")
+            logger.info("Admin %s reset onboarding for user %s", user_id, target_user_id)
         else:
             await m.reply_text(f"❌ User {target_user_id} has no onboarding record")
             
     except ValueError:
         await m.reply_text("❌ Invalid user ID. Usage: /resetonboarding [user_id]")
     except Exception as e:
-        logger.error(f"Error in reset onboarding command: {e}")
+        logger.error("Error in reset onboarding command: %s", e)
         await m.reply_text(f"Error: {e}")
 
-@app.on_message(filters.command("approvepending") & filters.user(cfg.SUDO))
-async def approve_pending_requests(_, m: Message):
-    """Approve all pending join requests (admin only)"""
-    user_id = m.from_user.id
+# Pending join requests are approved, recorded and onboarded in pages of this size
+APPROVE_PAGE_SIZE = 500
+# Concurrent approve_chat_join_request calls
+APPROVE_CONCURRENCY = 20
+
+async def approve_requests_individually(channel_id: int, user_ids: list):
+    """Approve join requests one by one over a bounded pool; returns the approved IDs"""
+    semaphore = asyncio.Semaphore(APPROVE_CONCURRENCY)
+    
+    async def approve_one(uid):
+        async with semaphore:
+            await send_scheduler.acquire()
+            try:
+                await app.approve_chat_join_request(channel_id, uid)
+                return uid
+            except Exception as e:
+                logger.error("Failed to approve request from %s: %s", uid, e)
+                return None
+    
+    results = await asyncio.gather(*[approve_one(uid) for uid in user_ids])
+    return {uid for uid in results if uid is not None}
+
+async def bulk_approve(admin_id: int, status_chat_id: int, status_message_id: int):
+    """Approve all pending join requests, reporting progress in the given status message"""
+    async def status(text):
+        await app.edit_message_text(status_chat_id, status_message_id, text)
     
     try:
-        status_msg = await m.reply_text("🔄 Processing pending requests...")
-        
-        approved = 0
-        failed = 0
-        
         # Debug and format channel ID properly
-        logger.info(f"Raw CHID from config: {cfg.CHID}")
+        logger.info("Raw CHID from config: %s", cfg.CHID)
         
         # Ensure channel ID is properly formatted with negative sign
         channel_id = int(cfg.CHID)
         if channel_id > 0:
             channel_id = -channel_id  # Add negative sign for supergroup IDs
             
-        logger.info(f"Processing pending requests for channel ID: {channel_id}")
+        logger.info("Processing pending requests for channel ID: %s", channel_id)
         
-        # Get all pending requests from the channel
+        # Collect all pending requests from the channel
+        pending = {}
         async for request in app.get_chat_join_requests(channel_id):
-            try:
-                await app.approve_chat_join_request(channel_id, request.user.id)
-                
-                # Add to database and start onboarding
-                add_user(request.user.id)
-                add_group(channel_id)
-                
-                # Start onboarding if not admin
-                if request.user.id not in cfg.SUDO:
-                    first_name = request.user.first_name or "Friend"
-                    
-                    # Reset existing onboarding for fresh start
-                    if already_onboarding(request.user.id):
-                        reset_onboarding(request.user.id)
-                    
-                    add_onboarding_user(request.user.id, first_name)
-                    
-                    # Try to send welcome message
-                    try:
-                        await send_welcome_message(request.user.id, first_name)
-                        await asyncio.sleep(2)
-                        await send_immediate_follow_up(request.user.id)
-                        update_onboarding_stage(request.user.id, "welcome_actually_sent")
-                    except errors.PeerIdInvalid:
-                        logger.info(f"User {request.user.id} hasn't started bot - welcome will be sent when they message")
-                    except Exception as e:
-                        logger.warning(f"Could not send welcome to {request.user.id}: {e}")
-                
-                approved += 1
-                
-                # Update status every 10 approvals
-                if approved % 10 == 0:
-                    await status_msg.edit_text(f"🔄 Approved {approved} requests so far...")
-                
-                # Rate limit to avoid flooding
-                await asyncio.sleep(0.5)
-                
-            except Exception as e:
-                logger.error(f"Failed to approve request from {request.user.id}: {e}")
-                failed += 1
+            pending[request.user.id] = request.user.first_name or "Friend"
         
-        result_text = f"✅ Bulk approval completed!\n\n📊 **Results:**\n• Approved: {approved}\n• Failed: {failed}"
-        await status_msg.edit_text(result_text)
-        logger.info(f"Admin {user_id} bulk approved {approved} pending requests")
+        if not pending:
+            await status("✅ No pending join requests!")
+            return
+        
+        await status(f"🔄 Approving {len(pending)} requests...")
+        
+        # Approve the listed requests a page at a time (approve-all would also approve
+        # requests that arrive meanwhile, which would then never be onboarded), then
+        # record users and onboarding for the confirmed ones and queue their welcome messages
+        listed = list(pending)
+        approved = []
+        for i in range(0, len(listed), APPROVE_PAGE_SIZE):
+            approved_ids = await approve_requests_individually(channel_id, listed[i:i + APPROVE_PAGE_SIZE])
+            page = [uid for uid in listed[i:i + APPROVE_PAGE_SIZE] if uid in approved_ids]
+            for uid in page:
+                membership_cache.set(channel_id, uid, True)
+            await register_joins(
+                [(uid, None if uid in cfg.SUDO else pending[uid]) for uid in page],
+                channel_id
+            )
+            welcomes = []
+            for uid in page:
+                if uid in cfg.SUDO:
+                    continue
+                schedule_first_follow_up(uid)
+                welcomes.append(welcome_sequence(uid, pending[uid]))
+                await update_onboarding_stage(uid, "welcome_queued")
+            if welcomes:
+                await enqueue_messages(*welcomes)
+            approved += page
+            await status(f"🔄 Approved {len(approved)} of {len(listed)} requests so far...")
+        
+        failed = len(pending) - len(approved)
+        result_text = f"✅ Bulk approval completed!\n\n📊 **Results:**\n• Approved: {len(approved)}\n• Failed: {failed}"
+        await status(result_text)
+        logger.info("Admin %s bulk approved %s pending requests", admin_id, len(approved))
         
     except Exception as e:
-        logger.error(f"Error in bulk approve command: {e}")
-        await m.reply_text(f"❌ Error: {e}")
+        logger.error("Error in bulk approve command: %s", e)
+        await status(f"❌ Error: {e}")
+
+@app.on_message(filters.command("approvepending") & sudo_filter)
+async def approve_pending_requests(_, m: Message):
+    """Approve all pending join requests (admin only)"""
+    status_msg = await m.reply_text("🔄 Processing pending requests...")
+    
+    # Hand the job to a background worker process when there are any
+    if worker_pool is not None:
+        worker_pool.submit(
+            cfg.BOT_OWNER, "approve_pending",
+            admin_id=m.from_user.id, status_chat_id=status_msg.chat.id, status_message_id=status_msg.id
+        )
+        return
+    
+    await bulk_approve(m.from_user.id, status_msg.chat.id, status_msg.id)
 
-@app.on_message(filters.command("checkpending") & filters.user(cfg.SUDO))
+@app.on_message(filters.command("checkpending") & sudo_filter)
 async def check_pending_requests(_, m: Message):
     """Check how many pending join requests exist (admin only)"""
     user_id = m.from_user.id
@@ -241,15 +374,15 @@ async def check_pending_requests(_, m: Message):
         pending_users = []
         
         # Debug channel ID formatting
-        logger.info(f"Raw CHID from config: {cfg.CHID}")
-        logger.info(f"CHID type: {type(cfg.CHID)}")
+        logger.info("Raw CHID from config: %s", cfg.CHID)
+        logger.info("CHID type: %s", type(cfg.CHID))
         
         # Ensure channel ID is properly formatted with negative sign
         channel_id = int(cfg.CHID)
         if channel_id > 0:
             channel_id = -channel_id  # Add negative sign for supergroup IDs
         
-        logger.info(f"Final channel ID for requests: {channel_id}")
+        logger.info("Final channel ID for requests: %s", channel_id)
         
         # Count all pending requests
         async for request in app.get_chat_join_requests(channel_id):
@@ -270,13 +403,13 @@ async def check_pending_requests(_, m: Message):
             result_text = f"📊 **Pending Join Requests: {pending_count}**\n\n👥 **Recent Users:**\n{user_list}\n\n💡 Use `/approvepending` to approve all at once"
         
         await status_msg.edit_text(result_text)
-        logger.info(f"Admin {user_id} checked pending requests: {pending_count} found")
+        logger.info("Admin %s checked pending requests: %s found", user_id, pending_count)
         
     except Exception as e:
-        logger.error(f"Error checking pending requests: {e}")
+        logger.error("Error checking pending requests: %s", e)
         await m.reply_text(f"❌ Error: {e}")
 
-@app.on_message(filters.command("checkconfig") & filters.user(cfg.SUDO))
+@app.on_message(filters.command("checkconfig") & sudo_filter)
 async def check_config(_, m: Message):
     """Check current bot configuration (admin only)"""
     user_id = m.from_user.id
@@ -300,13 +433,13 @@ async def check_config(_, m: Message):
 • Check your deployment logs for the actual channel ID"""
         
         await m.reply_text(config_info)
-        logger.info(f"Admin {user_id} checked bot configuration")
+        logger.info("Admin %s checked bot configuration", user_id)
         
     except Exception as e:
-        logger.error(f"Error checking config: {e}")
+        logger.error("Error checking config: %s", e)
         await m.reply_text(f"❌ Error: {e}")
 
-@app.on_message(filters.command("testbuttons") & filters.user(cfg.SUDO))
+@app.on_message(filters.command("testbuttons") & sudo_filter)
 async def test_buttons_command(_, m: Message):
     """Test button functionality (admin only)"""
     user_id = m.from_user.id
@@ -336,74 +469,35 @@ This is for debugging purposes only.
         """
         
         await m.reply_text(test_message, reply_markup=keyboard)
-        logger.info(f"Admin {user_id} initiated button test")
+        logger.info("Admin %s initiated button test", user_id)
         
     except Exception as e:
-        logger.error(f"Error in test buttons command: {e}")
+        logger.error("Error in test buttons command: %s", e)
         await m.reply_text(f"Error: {e}")
 
 #━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━ Onboarding Flow ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 
 async def send_welcome_message(user_id: int, first_name: str):
     """Send the initial welcome message"""
-    welcome_text = cfg.WELCOME_MESSAGE.format(first_name=first_name)
+    welcome_text = cfg.templates["welcome_message"].render(first_name=first_name)
     
     try:
         await rate_limited_send(app.send_message, user_id, welcome_text, disable_web_page_preview=True)
-        logger.info(f"Welcome message sent to user {user_id}")
-    except Exception as e:
-        logger.error(f"Error sending welcome message to {user_id}: {e}")
-
-async def send_immediate_follow_up(user_id: int):
-    """Send immediate follow-up message"""
-    follow_up_text = cfg.IMMEDIATE_FOLLOW_UP
-    
-    try:
-        await rate_limited_send(app.send_message, user_id, follow_up_text, disable_web_page_preview=True)
-        logger.info(f"Immediate follow-up sent to user {user_id}")
-    except Exception as e:
-        logger.error(f"Error sending immediate follow-up to {user_id}: {e}")
-
-async def send_setup_instructions(user_id: int, first_name: str):
-    """Send setup instructions after /start command"""
-    setup_text = cfg.SETUP_INSTRUCTIONS.format(
-        first_name=first_name,
-        deposit_guide_link=cfg.DEPOSIT_GUIDE_LINK,
-        results_channel_link=cfg.RESULTS_CHANNEL_LINK,
-        support_username=cfg.SUPPORT_USERNAME
-    )
-    
-    try:
-        await rate_limited_send(app.send_message, user_id, setup_text, disable_web_page_preview=True)
-        logger.info(f"Setup instructions sent to user {user_id}")
-    except Exception as e:
-        logger.error(f"Error sending setup instructions to {user_id}: {e}")
-
-async def send_support_message(user_id: int):
-    """Send support message"""
-    support_text = cfg.SUPPORT_MESSAGE.format(
-        support_username=cfg.SUPPORT_USERNAME,
-        deposit_guide_link=cfg.DEPOSIT_GUIDE_LINK,
-        results_channel_link=cfg.RESULTS_CHANNEL_LINK
-    )
-    
-    try:
-        await rate_limited_send(app.send_message, user_id, support_text, disable_web_page_preview=True)
-        logger.info(f"Support message sent to user {user_id}")
+        logger.info("Welcome message sent to user %s", user_id)
     except Exception as e:
-        logger.error(f"Error sending support message to {user_id}: {e}")
+        logger.error("Error sending welcome message to %s: %s", user_id, e)
 
 async def send_1hour_follow_up(user_id: int):
     """Send 1-hour follow-up with Yes/No buttons and WhatsApp link"""
     # Check if WhatsApp link is available
-    whatsapp_link = get_whatsapp_link()
+    whatsapp_link = await get_whatsapp_link()
     if not whatsapp_link:
-        logger.info(f"Skipping 1-hour follow-up for user {user_id}: No WhatsApp link set")
-        mark_follow_up_sent(user_id, "1h")
+        logger.info("Skipping 1-hour follow-up for user %s: No WhatsApp link set", user_id)
+        await mark_follow_up_sent(user_id, "1h")
         return
     
     # Include WhatsApp link in the message
-    follow_up_text = cfg.FOLLOW_UP_1H.format(whatsapp_link=whatsapp_link)
+    follow_up_text = cfg.templates["follow_up_1h"].render(whatsapp_link=whatsapp_link)
     
     keyboard = InlineKeyboardMarkup([
         [
@@ -414,55 +508,118 @@ async def send_1hour_follow_up(user_id: int):
     
     try:
         await rate_limited_send(app.send_message, user_id, follow_up_text, reply_markup=keyboard, disable_web_page_preview=True)
-        mark_follow_up_sent(user_id, "1h")
-        logger.info(f"1-hour follow-up sent to user {user_id} with WhatsApp link")
+        await mark_follow_up_sent(user_id, "1h")
+        logger.info("1-hour follow-up sent to user %s with WhatsApp link", user_id)
     except errors.PeerIdInvalid:
-        logger.warning(f"Cannot send follow-up to {user_id}: User hasn't started the bot yet")
-        mark_follow_up_sent(user_id, "1h")
+        logger.warning("Cannot send follow-up to %s: User hasn't started the bot yet", user_id)
+        await mark_follow_up_sent(user_id, "1h")
     except errors.UserIsBlocked:
-        logger.warning(f"User {user_id} has blocked the bot")
-        mark_follow_up_sent(user_id, "1h")
+        logger.warning("User %s has blocked the bot", user_id)
+        await mark_follow_up_sent(user_id, "1h")
     except Exception as e:
-        logger.error(f"Error sending 1-hour follow-up to {user_id}: {e}")
+        logger.error("Error sending 1-hour follow-up to %s: %s", user_id, e)
 
 async def send_3hour_follow_up(user_id: int, first_name: str):
     """Send 3-hour follow-up"""
-    follow_up_text = cfg.FOLLOW_UP_3H.format(
-        first_name=first_name,
-        direct_contact_username=cfg.DIRECT_CONTACT_USERNAME,
-        deposit_guide_link=cfg.DEPOSIT_GUIDE_LINK
-    )
+    follow_up_text = cfg.templates["follow_up_3h"].render(first_name=first_name)
     
     try:
         await rate_limited_send(app.send_message, user_id, follow_up_text, disable_web_page_preview=True)
-        mark_follow_up_sent(user_id, "3h")
-        logger.info(f"3-hour follow-up sent to user {user_id}")
+        await mark_follow_up_sent(user_id, "3h")
+        logger.info("3-hour follow-up sent to user %s", user_id)
     except errors.PeerIdInvalid:
-        logger.warning(f"Cannot send 3h follow-up to {user_id}: User hasn't started the bot yet")
-        mark_follow_up_sent(user_id, "3h")
+        logger.warning("Cannot send 3h follow-up to %s: User hasn't started the bot yet", user_id)
+        await mark_follow_up_sent(user_id, "3h")
     except errors.UserIsBlocked:
-        logger.warning(f"User {user_id} has blocked the bot")
-        mark_follow_up_sent(user_id, "3h")
+        logger.warning("User %s has blocked the bot", user_id)
+        await mark_follow_up_sent(user_id, "3h")
     except Exception as e:
-        logger.error(f"Error sending 3-hour follow-up to {user_id}: {e}")
+        logger.error("Error sending 3-hour follow-up to %s: %s", user_id, e)
 
 #━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━ Scheduler Functions ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 
-async def process_follow_ups():
-    """Process scheduled follow-ups"""
-    try:
-        # Process 1-minute follow-ups (configurable)
-        users_1m = get_users_for_follow_up("1h", cfg.FOLLOW_UP_1_MINUTES)
-        for user in users_1m:
-            await send_1hour_follow_up(int(user["user_id"]))
-        
-        # Process 3-minute follow-ups (configurable)
-        users_3m = get_users_for_follow_up("3h", cfg.FOLLOW_UP_3_MINUTES)
-        for user in users_3m:
-            await send_3hour_follow_up(int(user["user_id"]), user["first_name"])
-            
-    except Exception as e:
-        logger.error(f"Error processing follow-ups: {e}")
+# Follow-ups fire at created_at + FOLLOW_UP_X_MINUTES from a due-time heap
+follow_up_scheduler = tenant_local(lambda: FollowUpScheduler({
+    "1h": lambda user: send_1hour_follow_up(int(user["user_id"])),
+    "3h": lambda user: send_3hour_follow_up(int(user["user_id"]), user.get("first_name") or "Friend")
+}, shard_leases))
+
+# Welcome sequences are persisted in the outbox and sent by the delivery queue's consumers
+delivery_queue = tenant_local(lambda: DeliveryQueue(app, rate_limited_send, workers=cfg.DELIVERY_WORKERS))
+
+# Seconds between the welcome message and the immediate follow-up
+WELCOME_FOLLOW_UP_DELAY = 2
+# Seconds between the messages sent for /start and Check Again
+START_MESSAGE_DELAY = 2
+# Stages a delivered or failed welcome may move a user out of; later stages are kept
+WELCOME_STAGES = ("welcome_sent", "welcome_queued")
+
+def welcome_sequence(user_id: int, first_name: str, then=None):
+    """Outbox message for the welcome text, chained to the immediate follow-up and stage update
+
+    If the welcome can't be delivered (e.g. the user hasn't started the bot),
+    the stage goes back to 'welcome_sent' so it is retried when they message us.
+    `then` is queued after the immediate follow-up.
+    """
+    return outbox_message(
+        user_id,
+        cfg.templates["welcome_message"].render(first_name=first_name),
+        on_failed_stage="welcome_sent",
+        stage_from=WELCOME_STAGES,
+        then=outbox_message(
+            user_id,
+            cfg.templates["immediate_follow_up"].render(),
+            delay=WELCOME_FOLLOW_UP_DELAY,
+            on_sent_stage="welcome_actually_sent",
+            stage_from=WELCOME_STAGES,
+            then=then
+        )
+    )
+
+def start_sequence(user_id: int, first_name: str, welcome: bool):
+    """Outbox messages for /start and Check Again: setup instructions, then the support message
+
+    With `welcome`, the welcome sequence is sent first.
+    """
+    setup = outbox_message(
+        user_id,
+        cfg.templates["setup_instructions"].render(first_name=first_name),
+        delay=START_MESSAGE_DELAY if welcome else 0,
+        then=outbox_message(user_id, cfg.templates["support_message"].render(), delay=START_MESSAGE_DELAY)
+    )
+    return welcome_sequence(user_id, first_name, then=setup) if welcome else setup
+
+async def enqueue_welcome_sequence(user_id: int, first_name: str):
+    """Queue the welcome message, then the immediate follow-up and stage update"""
+    # Mark it queued so further messages from the user don't queue it again
+    await update_onboarding_stage(user_id, "welcome_queued")
+    await enqueue_messages(welcome_sequence(user_id, first_name))
+
+def schedule_first_follow_up(user_id: int):
+    """Queue the first follow-up for a freshly onboarded user
+
+    Users in shards leased by other workers are picked up by their polling.
+    """
+    due_at = time.time() + cfg.FOLLOW_UP_1_MINUTES * 60
+    follow_up_scheduler.schedule(user_id, due_at)
+    notify_workers("follow_up", user_id=str(user_id), due_at=due_at)
+
+async def enqueue_messages(*messages):
+    """Persist outgoing messages and wake whichever process delivers them"""
+    await delivery_queue.enqueue(*messages)
+    notify_workers("outbox")
+
+async def start_onboarding(user_id: int, first_name: str, chat_id: int = None):
+    """Record the user (and group) with a fresh onboarding record and queue its first follow-up"""
+    await register_join(user_id, first_name, chat_id)
+    schedule_first_follow_up(user_id)
+
+async def onboard_new_user(user_id: int, first_name: str):
+    """Start onboarding for a user with no record; returns False if another handler got there first"""
+    created, _ = await asyncio.gather(create_onboarding_user(user_id, first_name), add_user(user_id))
+    if created:
+        schedule_first_follow_up(user_id)
+    return created
 
 #━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━ Main process ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 
@@ -471,17 +628,12 @@ async def approve(_, m: Message):
     """Auto-approve chat join requests and start onboarding flow"""
     op = m.chat
     kk = m.from_user
-    logger.info(f"🔍 DEBUG: Join request received from user {kk.id} ({kk.first_name}) in chat {op.id} ({op.title})")
+    logger.debug("Join request received from user %s (%s) in chat %s (%s)", kk.id, kk.first_name, op.id, op.title)
     
     try:
-        add_group(m.chat.id)
-        logger.info(f"🔍 DEBUG: Added group {op.id} to database")
-        
         await app.approve_chat_join_request(op.id, kk.id)
-        logger.info(f"🔍 DEBUG: Approved join request for user {kk.id}")
-        
-        add_user(kk.id)
-        logger.info(f"🔍 DEBUG: Added user {kk.id} to database")
+        membership_cache.set(op.id, kk.id, True)
+        logger.debug("Approved join request for user %s", kk.id)
         
         # Start onboarding flow for new users (skip if admin)
         user_id = kk.id
@@ -489,52 +641,26 @@ async def approve(_, m: Message):
         
         # Skip onboarding for admins
         if user_id in cfg.SUDO:
-            logger.info(f"🔍 DEBUG: Skipping onboarding for admin user {user_id}")
-            logger.info(f"Approved join request for admin user {kk.id} in chat {op.id}")
+            await register_join(user_id, chat_id=op.id)
+            logger.debug("Added admin %s and group %s to database", user_id, op.id)
+            logger.debug("Skipping onboarding for admin user %s", user_id)
+            logger.info("Approved join request for admin user %s in chat %s", kk.id, op.id)
             return
         
-        logger.info(f"🔍 DEBUG: Starting onboarding process for user {user_id}")
+        logger.debug("Starting onboarding process for user %s", user_id)
         
-        # Always reset onboarding for fresh start (handles rejoin scenarios)
-        if already_onboarding(user_id):
-            logger.info(f"🔍 DEBUG: User {user_id} has existing onboarding record - resetting for fresh start")
-            # Remove existing onboarding record
-            reset_onboarding(user_id)
-            logger.info(f"🔍 DEBUG: Removed existing onboarding record for user {user_id}")
+        # Always create a fresh onboarding record (handles rejoin scenarios)
+        await start_onboarding(user_id, first_name, op.id)
+        logger.debug("Recorded user %s, group %s and fresh onboarding record", user_id, op.id)
         
-        # Create fresh onboarding record for all users
-        logger.info(f"🔍 DEBUG: Creating fresh onboarding record for user {user_id}")
-        add_onboarding_user(user_id, first_name)
-        logger.info(f"🔍 DEBUG: Added user {user_id} to onboarding database")
+        # Hand the welcome sequence to the delivery queue so approval returns immediately
+        await enqueue_welcome_sequence(user_id, first_name)
+        logger.debug("Queued welcome sequence for user %s", user_id)
         
-        # Always try to send welcome message on approval
-        try:
-            logger.info(f"🔍 DEBUG: Attempting to send welcome message to user {user_id}")
-            await send_welcome_message(user_id, first_name)
-            logger.info(f"🔍 DEBUG: Welcome message sent successfully to user {user_id}")
-            
-            # Send immediate follow-up after a short delay
-            await asyncio.sleep(2)
-            logger.info(f"🔍 DEBUG: Sending immediate follow-up to user {user_id}")
-            await send_immediate_follow_up(user_id)
-            logger.info(f"🔍 DEBUG: Immediate follow-up sent to user {user_id}")
-            
-            # Update stage to indicate welcome was sent
-            update_onboarding_stage(user_id, "welcome_actually_sent")
-            logger.info(f"🔍 DEBUG: Updated onboarding stage for user {user_id} to 'welcome_actually_sent'")
-            logger.info(f"Started onboarding for user {user_id} after auto-approval")
-            
-        except errors.PeerIdInvalid:
-            logger.warning(f"🔍 DEBUG: PeerIdInvalid - User {user_id} hasn't started the bot - will send welcome when they message us")
-            logger.info(f"🔍 DEBUG: Onboarding stage remains 'welcome_sent' (will send when user messages us)")
-        except Exception as e:
-            logger.error(f"🔍 DEBUG: Error sending welcome message to {user_id}: {e}")
-            logger.exception("Full exception details:")
-        
-        logger.info(f"🔍 DEBUG: Approval process completed for user {kk.id} in chat {op.id}")
+        logger.info("Approved join request for user %s in chat %s", kk.id, op.id)
         
     except Exception as err:
-        logger.error(f"🔍 DEBUG: Error in approval process: {str(err)}")
+        logger.error("Error in approval process: %s", err)
         logger.exception("Full exception details:")
 
 #━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━ New User Detection ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
@@ -547,45 +673,27 @@ async def handle_new_user(_, m: Message):
     
     # Skip if it's a command (additional safety check)
     if m.text and m.text.startswith('/'):
-        logger.info(f"🔍 DEBUG: Skipping command in handle_new_user: {m.text}")
+        logger.debug("Skipping command in handle_new_user: %s", m.text)
         return
     
     # Skip onboarding for admins
     if user_id in cfg.SUDO:
-        logger.info(f"Skipping onboarding for admin user {user_id} in private message")
+        logger.info("Skipping onboarding for admin user %s in private message", user_id)
         return
     
     # Check if user is in onboarding
-    if already_onboarding(user_id):
-        user_data = get_onboarding_user(user_id)
-        if user_data and user_data.get("onboarding_stage") == "welcome_sent":
+    user_data = await get_onboarding_user(user_id)
+    if user_data:
+        if user_data.get("onboarding_stage") == "welcome_sent":
             # User was auto-approved but welcome message wasn't sent due to PeerIdInvalid
             # Now they've messaged the bot, so we can send the onboarding flow
-            await send_welcome_message(user_id, first_name)
-            
-            # Send immediate follow-up after a short delay
-            await asyncio.sleep(2)
-            await send_immediate_follow_up(user_id)
-            
-            # Update stage to indicate welcome was actually sent
-            update_onboarding_stage(user_id, "welcome_actually_sent")
-            logger.info(f"Sent delayed welcome message to user {user_id}")
+            await enqueue_welcome_sequence(user_id, first_name)
+            logger.info("Queued delayed welcome message for user %s", user_id)
         # If they already got welcome message, do nothing (avoid spam)
-    else:
+    elif await onboard_new_user(user_id, first_name):
         # Completely new user who didn't come through channel approval
-        add_onboarding_user(user_id, first_name)
-        add_user(user_id)
-        
-        # Send welcome message
-        await send_welcome_message(user_id, first_name)
-        
-        # Send immediate follow-up after a short delay
-        await asyncio.sleep(2)
-        await send_immediate_follow_up(user_id)
-        
-        # Update stage
-        update_onboarding_stage(user_id, "welcome_actually_sent")
-        logger.info(f"Started onboarding for new user {user_id}")
+        await enqueue_welcome_sequence(user_id, first_name)
+        logger.info("Started onboarding for new user %s", user_id)
 
 #━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━ Start Command ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 
@@ -598,26 +706,25 @@ async def start_command(_, m: Message):
     # Skip onboarding for admins
     if user_id in cfg.SUDO:
         await m.reply_text("👋 Welcome back, Admin!")
-        logger.info(f"Admin {user_id} used /start command")
+        logger.info("Admin %s used /start command", user_id)
         return
     
-    # Check if user is member of required channel
-    try:
-        print("🔍 DEBUG: User is member of required channel")
-        # await send_setup_instructions(user_id, first_name)
-        # await app.get_chat_member(cfg.CHID, user_id)
-    except:
+    # Check if user is member of required channel (off unless REQUIRE_CHANNEL_MEMBERSHIP is set)
+    if cfg.REQUIRE_CHANNEL_MEMBERSHIP and not await is_channel_member(user_id):
         try:
-            invite_link = await app.create_chat_invite_link(int(cfg.CHID))
+            invite_link = await invite_link_pool.get()
+            if invite_link is None:
+                # Pool not filled yet (e.g. right after the first start)
+                invite_link = (await invite_link_pool.create())["link"]
         except Exception as e:
-            logger.error(f"Error creating invite link: {str(e)}")
+            logger.error("Error creating invite link: %s", e)
             # await m.reply("**Make Sure I Am Admin In Your Channel**")
             await m.reply("**Welcome**")
             return
         
         key = InlineKeyboardMarkup([
             [
-                InlineKeyboardButton("🍿 Join Update Channel 🍿", url=invite_link.invite_link),
+                InlineKeyboardButton("🍿 Join Update Channel 🍿", url=invite_link),
                 InlineKeyboardButton("🍀 Check Again 🍀", callback_data="chk")
             ]
         ])
@@ -631,53 +738,71 @@ async def start_command(_, m: Message):
         return
     
     # User is authorized - check onboarding status
-    if already_onboarding(user_id):
-        user_data = get_onboarding_user(user_id)
-        if user_data and user_data.get("onboarding_stage") == "welcome_sent":
-            # User was auto-approved but welcome message wasn't sent yet
-            # Send welcome message first
-            await send_welcome_message(user_id, first_name)
-            await asyncio.sleep(2)
-            await send_immediate_follow_up(user_id)
-            await asyncio.sleep(2)
+    user_data = await get_onboarding_user(user_id)
+    if user_data:
+        # User was auto-approved but welcome message wasn't sent yet: send it first
+        welcome = user_data.get("onboarding_stage") == "welcome_sent"
     else:
-        # Completely new user - start onboarding
-        add_onboarding_user(user_id, first_name)
-        add_user(user_id)
-        
-        # Send welcome message first
-        await send_welcome_message(user_id, first_name)
-        await asyncio.sleep(2)
-        await send_immediate_follow_up(user_id)
-        await asyncio.sleep(2)
-    
-    # Send setup instructions
-    await send_setup_instructions(user_id, first_name)
+        # Completely new user - start onboarding and send the welcome first
+        welcome = await onboard_new_user(user_id, first_name)
     
-    # Send support message
-    await asyncio.sleep(2)
-    await send_support_message(user_id)
+    # Queue the setup instructions and support message (after the welcome, if any)
+    await enqueue_messages(start_sequence(user_id, first_name, welcome))
     
     # Update onboarding stage
-    update_onboarding_stage(user_id, "start_clicked")
+    await update_onboarding_stage(user_id, "start_clicked")
     
-    logger.info(f"User {user_id} clicked /start")
+    logger.info("User %s clicked /start", user_id)
 
 #━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━ Callback Handlers ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 
+async def is_channel_member(user_id: int) -> bool:
+    """Check channel membership, asking Telegram only when the cache has no answer
+
+    Only UserNotParticipant counts as "not a member". Other errors (e.g. the
+    bot is not an admin of the channel) are logged and let the user through.
+    """
+    cached = membership_cache.get(cfg.CHID, user_id)
+    if cached is not None:
+        logger.debug("Channel membership of user %s served from cache: %s", user_id, cached)
+        return cached
+    
+    try:
+        await app.get_chat_member(cfg.CHID, user_id)
+        logger.debug("User %s is verified as channel member", user_id)
+        membership_cache.set(cfg.CHID, user_id, True)
+        return True
+    except UserNotParticipant as e:
+        logger.debug("User %s is not a channel member: %s", user_id, e)
+        membership_cache.set(cfg.CHID, user_id, False)
+        return False
+    except Exception as e:
+        # Not cached: the answer may be different once the error clears
+        logger.warning("Could not check channel membership of user %s, letting them through: %s", user_id, e)
+        return True
+
+@app.on_chat_member_updated()
+async def track_channel_membership(_, update: ChatMemberUpdated):
+    """Keep the membership cache current as users join and leave"""
+    member = update.new_chat_member or update.old_chat_member
+    if member is None or member.user is None:
+        return
+    new = update.new_chat_member
+    is_member = new is not None and (
+        new.status in (enums.ChatMemberStatus.OWNER, enums.ChatMemberStatus.ADMINISTRATOR, enums.ChatMemberStatus.MEMBER)
+        or (new.status == enums.ChatMemberStatus.RESTRICTED and bool(new.is_member))
+    )
+    membership_cache.set(update.chat.id, member.user.id, is_member)
+
 @app.on_callback_query(filters.regex("chk"))
 async def check_subscription(_, cb: CallbackQuery):
     """Handle check subscription callback"""
     user_id = cb.from_user.id
     first_name = cb.from_user.first_name or "Friend"
     
-    logger.info(f"🔍 DEBUG: User {user_id} clicked 'Check Again' button")
+    logger.debug("User %s clicked 'Check Again' button", user_id)
     
-    try:
-        await app.get_chat_member(cfg.CHID, user_id)
-        logger.info(f"🔍 DEBUG: User {user_id} is verified as channel member")
-    except Exception as e:
-        logger.info(f"🔍 DEBUG: User {user_id} is not a channel member: {e}")
+    if not await is_channel_member(user_id):
         await cb.answer(
             "🙅‍♂️ You are not joined my channel first join channel then check again. 🙅‍♂️",
             show_alert=True
@@ -687,52 +812,36 @@ async def check_subscription(_, cb: CallbackQuery):
     # Skip onboarding for admins
     if user_id in cfg.SUDO:
         await cb.edit_message_text("👋 Welcome back, Admin!")
-        logger.info(f"Admin {user_id} verified subscription")
+        logger.info("Admin %s verified subscription", user_id)
         return
     
     # User verified - check onboarding status
-    if already_onboarding(user_id):
-        user_data = get_onboarding_user(user_id)
-        if user_data and user_data.get("onboarding_stage") == "welcome_sent":
-            # User was auto-approved but welcome message wasn't sent yet
-            # Send welcome message first
-            await send_welcome_message(user_id, first_name)
-            await asyncio.sleep(2)
-            await send_immediate_follow_up(user_id)
-            await asyncio.sleep(2)
+    user_data = await get_onboarding_user(user_id)
+    if user_data:
+        # User was auto-approved but welcome message wasn't sent yet: send it first
+        welcome = user_data.get("onboarding_stage") == "welcome_sent"
     else:
-        # Completely new user - start onboarding
-        add_onboarding_user(user_id, first_name)
-        add_user(user_id)
-        
-        # Send welcome message
-        await send_welcome_message(user_id, first_name)
-        await asyncio.sleep(2)
-        await send_immediate_follow_up(user_id)
-        await asyncio.sleep(2)
-    
-    # Send setup instructions
-    await send_setup_instructions(user_id, first_name)
+        # Completely new user - start onboarding and send the welcome first
+        welcome = await onboard_new_user(user_id, first_name)
     
-    # Send support message
-    await asyncio.sleep(2)
-    await send_support_message(user_id)
+    # Queue the setup instructions and support message (after the welcome, if any)
+    await enqueue_messages(start_sequence(user_id, first_name, welcome))
     
     # Update onboarding stage
-    update_onboarding_stage(user_id, "verified")
+    await update_onboarding_stage(user_id, "verified")
     
     try:
         await cb.edit_message_text("✅ Welcome! Check your messages for setup instructions.")
-        logger.info(f"🔍 DEBUG: Successfully edited subscription verification message for user {user_id}")
+        logger.debug("Successfully edited subscription verification message for user %s", user_id)
     except Exception as e:
-        logger.error(f"🔍 DEBUG: Error editing subscription verification message for user {user_id}: {e}")
+        logger.error("Error editing subscription verification message for user %s: %s", user_id, e)
         # Try to answer callback if editing failed
         try:
             await cb.answer("✅ Welcome! Check your private messages for setup instructions.", show_alert=True)
         except:
             pass
     
-    logger.info(f"User {user_id} verified subscription")
+    logger.info("User %s verified subscription", user_id)
 
 @app.on_callback_query(filters.regex("setup_yes"))
 async def setup_yes_callback(_, cb: CallbackQuery):
@@ -740,26 +849,26 @@ async def setup_yes_callback(_, cb: CallbackQuery):
     user_id = cb.from_user.id
     
     try:
-        logger.info(f"🔍 DEBUG: User {user_id} clicked 'Yes, I have' button")
+        logger.debug("User %s clicked 'Yes, I have' button", user_id)
         
-        response_text = cfg.SETUP_COMPLETED_MSG
+        response_text = cfg.templates["setup_completed_msg"].render()
         
         # Try to edit the message
         await cb.edit_message_text(response_text)
-        logger.info(f"🔍 DEBUG: Successfully edited message for user {user_id}")
+        logger.debug("Successfully edited message for user %s", user_id)
         
         # Mark as completed
-        mark_setup_completed(user_id, True)
-        mark_account_verified(user_id, True)
-        update_onboarding_stage(user_id, "completed")
+        await mark_setup_completed(user_id, True)
+        await mark_account_verified(user_id, True)
+        await update_onboarding_stage(user_id, "completed")
         
-        logger.info(f"User {user_id} confirmed setup completion")
+        logger.info("User %s confirmed setup completion", user_id)
         
         # Send confirmation callback answer
         await cb.answer("✅ Great! Setup completed successfully!", show_alert=False)
         
     except Exception as e:
-        logger.error(f"🔍 DEBUG: Error in setup_yes_callback for user {user_id}: {e}")
+        logger.error("Error in setup_yes_callback for user %s: %s", user_id, e)
         logger.exception("Full exception details:")
         # Try to answer the callback even if editing failed
         try:
@@ -773,28 +882,24 @@ async def setup_no_callback(_, cb: CallbackQuery):
     user_id = cb.from_user.id
     
     try:
-        logger.info(f"🔍 DEBUG: User {user_id} clicked 'No, not yet' button")
+        logger.debug("User %s clicked 'No, not yet' button", user_id)
         
-        response_text = cfg.SETUP_REMINDER_MSG.format(
-            deposit_guide_link=cfg.DEPOSIT_GUIDE_LINK,
-            promo_code=cfg.PROMO_CODE,
-            support_username=cfg.SUPPORT_USERNAME
-        )
+        response_text = cfg.templates["setup_reminder_msg"].render()
         
         # Try to edit the message
         await cb.edit_message_text(response_text)
-        logger.info(f"🔍 DEBUG: Successfully edited message for user {user_id}")
+        logger.debug("Successfully edited message for user %s", user_id)
         
         # Update stage but don't mark as completed
-        update_onboarding_stage(user_id, "setup_reminder_sent")
+        await update_onboarding_stage(user_id, "setup_reminder_sent")
         
-        logger.info(f"User {user_id} needs setup reminder")
+        logger.info("User %s needs setup reminder", user_id)
         
         # Send confirmation callback answer
         await cb.answer("📝 No problem! Here's a reminder to help you get started.", show_alert=False)
         
     except Exception as e:
-        logger.error(f"🔍 DEBUG: Error in setup_no_callback for user {user_id}: {e}")
+        logger.error("Error in setup_no_callback for user %s: %s", user_id, e)
         logger.exception("Full exception details:")
         # Try to answer the callback even if editing failed
         try:
@@ -804,7 +909,7 @@ async def setup_no_callback(_, cb: CallbackQuery):
 
 #━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━ Admin Commands ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 
-@app.on_message(filters.command("setlink") & filters.user(cfg.SUDO))
+@app.on_message(filters.command("setlink") & sudo_filter)
 async def set_whatsapp_link_command(_, m: Message):
     """Set WhatsApp link for follow-up messages (admin only)"""
     user_id = m.from_user.id
@@ -812,7 +917,7 @@ async def set_whatsapp_link_command(_, m: Message):
     try:
         parts = m.text.split(' ', 1)
         if len(parts) < 2:
-            current_link = get_whatsapp_link()
+            current_link = await get_whatsapp_link()
             if current_link:
                 await m.reply_text(f"Current WhatsApp link: {current_link}\n\nUsage: /setlink <whatsapp_link>")
             else:
@@ -826,285 +931,256 @@ async def set_whatsapp_link_command(_, m: Message):
             await m.reply_text("❌ Invalid WhatsApp link format. Please use:\n• https://wa.me/phonenumber\n• https://chat.whatsapp.com/grouplink")
             return
         
-        set_whatsapp_link(whatsapp_link)
+        await set_whatsapp_link(whatsapp_link)
         await m.reply_text(f"✅ WhatsApp link updated successfully!\n\nNew link: {whatsapp_link}")
-        logger.info(f"Admin {user_id} set WhatsApp link: {whatsapp_link}")
+        logger.info("Admin %s set WhatsApp link: %s", user_id, whatsapp_link)
         
     except Exception as e:
-        logger.error(f"Error in setlink command: {e}")
+        logger.error("Error in setlink command: %s", e)
         await m.reply_text(f"❌ Error: {e}")
 
-@app.on_message(filters.command("users") & filters.user(cfg.SUDO))
+@app.on_message(filters.command("users") & sudo_filter)
 async def get_stats(_, m: Message):
     """Get bot statistics (admin only)"""
     try:
-        logger.info(f"Stats command triggered by user {m.from_user.id}")
-        xx = all_users()
-        x = all_groups()
+        logger.info("Stats command triggered by user %s", m.from_user.id)
+        stats = stats_snapshot if stats_snapshot["updated_at"] else await refresh_stats()
+        xx = stats["users"]
+        x = stats["groups"]
         tot = int(xx + x)
         
+        funnel = "\n".join(
+            f"• {stage or 'unknown'} : `{count}`"
+            for stage, count in sorted(stats["funnel"].items(), key=lambda item: -item[1])
+        ) or "• No onboarding records yet"
+        
         stats_text = f"""
 🍀 Chats Stats 🍀
 🙋‍♂️ Users : `{xx}`
 👥 Groups : `{x}`
 🚧 Total users & groups : `{tot}`
+
+📈 Onboarding Funnel
+{funnel}
+
+🕒 Updated : `{stats["updated_at"].strftime('%Y-%m-%d %H:%M:%S')} UTC`
         """
         
         await m.reply_text(text=stats_text)
-        logger.info(f"Stats requested by admin {m.from_user.id}")
+        logger.info("Stats requested by admin %s", m.from_user.id)
         
     except Exception as e:
-        logger.error(f"Error getting stats: {str(e)}")
+        logger.error("Error getting stats: %s", e)
         await m.reply_text("Error getting statistics.")
 
+async def run_periodically(func, interval: float):
+    """Run a coroutine function every `interval` seconds in the background"""
+    while True:
+        try:
+            await func()
+        except Exception as e:
+            logger.error("Error in periodic task %s: %s", func.__name__, e)
+        await asyncio.sleep(interval)
+
 #━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━ Broadcast ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 
-@app.on_message(filters.command("bcast") & filters.user(cfg.SUDO))
+@app.on_message(filters.command("bcast") & sudo_filter)
 async def broadcast(_, m: Message):
-    print("=======================in broadcast")
     """Broadcast message to all users (admin only)"""
-    logger.info(f"Broadcast command triggered by user {m.from_user.id}")
+    logger.info("Broadcast command triggered by user %s", m.from_user.id)
     if not m.reply_to_message:
-        print("=======================no reply to message")
         await m.reply_text("Please reply to a message to broadcast.")
         return
     
-    print("========================try to get users")
-    allusers = users
     lel = await m.reply_text("`⚡️ Processing...`")
-    success = 0
-    failed = 0
-    deactivated = 0
-    blocked = 0
-    
-    for usrs in allusers.find():
-        print("====================looking for all users")
-        try:
-            userid = usrs["user_id"]
-            
-            # Check if the message contains [firstname] placeholder
-            if m.reply_to_message.text and "[firstname]" in m.reply_to_message.text:
-                # Try to get user's first name from onboarding data first
-                user_data = get_onboarding_user(userid)
-                first_name = "Friend"  # Default fallback
-                
-                if user_data and user_data.get("first_name"):
-                    first_name = user_data.get("first_name")
-                else:
-                    # Try to get first name from Telegram user object
-                    try:
-                        user = await app.get_users(int(userid))
-                        first_name = user.first_name or "Friend"
-                    except Exception:
-                        first_name = "Friend"
-                
-                # Ensure first_name is never None
-                if first_name is None:
-                    first_name = "Friend"
-                
-                # Replace [firstname] with actual first name
-                personalized_text = m.reply_to_message.text.replace("[firstname]", first_name)
-                
-                # Send personalized message
-                await app.send_message(
-                    int(userid),
-                    personalized_text,
-                    reply_markup=m.reply_to_message.reply_markup,
-                    disable_web_page_preview=True
-                )
-            else:
-                # Regular broadcast without personalization
-                await m.reply_to_message.copy(int(userid))
-            
-            success += 1
-        except FloodWait as ex:
-            await asyncio.sleep(ex.value)
-            # Retry with same personalization logic
-            if m.reply_to_message.text and "[firstname]" in m.reply_to_message.text:
-                user_data = get_onboarding_user(userid)
-                first_name = "Friend"  # Default fallback
-                
-                if user_data and user_data.get("first_name"):
-                    first_name = user_data.get("first_name")
-                else:
-                    try:
-                        user = await app.get_users(int(userid))
-                        first_name = user.first_name or "Friend"
-                    except Exception:
-                        first_name = "Friend"
-                
-                personalized_text = m.reply_to_message.text.replace("[firstname]", first_name)
-                await app.send_message(
-                    int(userid),
-                    personalized_text,
-                    reply_markup=m.reply_to_message.reply_markup,
-                    disable_web_page_preview=True
-                )
-            else:
-                await m.reply_to_message.copy(int(userid))
-        except errors.InputUserDeactivated:
-            deactivated += 1
-            remove_user(userid)
-        except errors.UserIsBlocked:
-            blocked += 1
-            remove_user(userid)
-        except errors.PeerIdInvalid:
-            failed += 1
-            logger.warning(f"User {userid} hasn't started the bot yet - skipping broadcast")
-        except Exception as e:
-            logger.error(f"Broadcast error: {str(e)}")
-            failed += 1
-    
-    result_text = (
-        f"✅ Successfully sent to `{success}` users.\n"
-        f"❌ Failed to send to `{failed}` users.\n"
-        f"👾 Found `{blocked}` blocked users\n"
-        f"👻 Found `{deactivated}` deactivated users."
-    )
-    
-    await lel.edit(result_text)
-    logger.info(f"Broadcast completed by admin {m.from_user.id}: {success} successful, {failed} failed")
+    await broadcast_engine.start(m.reply_to_message, "copy", lel)
+    notify_workers("broadcast")
 
 #━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━ Broadcast Forward ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 
-@app.on_message(filters.command("fcast") & filters.user(cfg.SUDO))
+@app.on_message(filters.command("fcast") & sudo_filter)
 async def forward_broadcast(_, m: Message):
     """Forward message to all users (admin only)"""
-    logger.info(f"Forward broadcast command triggered by user {m.from_user.id}")
+    logger.info("Forward broadcast command triggered by user %s", m.from_user.id)
     if not m.reply_to_message:
         await m.reply_text("Please reply to a message to forward.")
         return
     
-    allusers = users
     lel = await m.reply_text("`⚡️ Processing...`")
-    success = 0
-    failed = 0
-    deactivated = 0
-    blocked = 0
+    await broadcast_engine.start(m.reply_to_message, "forward", lel)
+    notify_workers("broadcast")
+
+
+# Background tasks of the current tenant
+periodic_tasks = tenant_local(list)
+
+def timed_handler(callback):
+    """Wrap a handler callback so its latency is recorded (bot_handler_seconds)"""
+    @functools.wraps(callback)
+    async def wrapper(client, *args):
+        with metrics.handler_latency.time(tenant=cfg.BOT_OWNER, handler=callback.__name__):
+            return await callback(client, *args)
+    return wrapper
+
+def instrument_handlers(client: Client):
+    for handlers in client.dispatcher.groups.values():
+        for handler in handlers:
+            handler.callback = timed_handler(handler.callback)
+
+async def copy_handlers(source: Client):
+    """Register the handlers of the primary tenant's client on the current one"""
+    for group, handlers in source.dispatcher.groups.items():
+        for handler in handlers:
+            app.add_handler(handler, group)
+
+async def start_tenant():
+    """Start the current tenant's client and background services"""
+    logger.info("Starting tenant %s (DB_NAME: %s, role: %s)", cfg.BOT_OWNER, cfg.DB_NAME, cfg.WORKER_ROLE)
+    await ensure_indexes()
+    await ensure_shard_layout()
+    
+    # Start bot
+    await app.start()
+    
+    # Load runtime settings before anything reads them
+    await load_settings()
+    
+    # Take this process's share of the send budget before sending anything
+    await refresh_send_share()
+    periodic_tasks.append(asyncio.create_task(run_periodically(refresh_send_share, cfg.SHARD_LEASE_SECONDS / 3)))
+    if cfg.WORKER_ROLE != "worker":
+        tenant = get_tenant()
+        metrics.outbox_backlog.set_function(lambda: run_in_tenant(tenant, outbox_backlog), tenant=cfg.BOT_OWNER)
+    periodic_tasks.append(asyncio.create_task(run_periodically(refresh_settings, SETTINGS_REFRESH_SECONDS)))
+    if cfg.WORKER_ROLE != "worker":
+        periodic_tasks.append(asyncio.create_task(run_periodically(refresh_stats, STATS_REFRESH_SECONDS)))
+        if cfg.REQUIRE_CHANNEL_MEMBERSHIP:
+            periodic_tasks.append(asyncio.create_task(run_periodically(invite_link_pool.refresh, INVITE_LINK_REFRESH_SECONDS)))
+    
+    # Lease shards, then start delivery queue, follow-up scheduler and broadcasts
+    if runs_background():
+        await shard_leases.start()
+        await delivery_queue.start()
+        await follow_up_scheduler.start()
+        await broadcast_engine.run()
+        metrics.follow_up_backlog.set_function(follow_up_scheduler.pending, tenant=cfg.BOT_OWNER)
+
+async def stop_tenant():
+    """Stop the current tenant's background services and client"""
+    for task in periodic_tasks:
+        task.cancel()
+    if runs_background():
+        await broadcast_engine.stop()
+        await follow_up_scheduler.stop()
+        await delivery_queue.stop()
+        await shard_leases.stop()
+    await flush_onboarding_updates()
+    await remove_sender(SENDER_ID)
+    await app.stop()
+
+# Seconds between checks that the background worker processes are alive
+WORKER_SUPERVISE_SECONDS = 30
+# Long-running jobs handed to this process by the update-handling process
+worker_jobs = set()
+
+async def handle_worker_event(event: str, data: dict):
+    """Apply an event sent by the update-handling process (in a worker process)"""
+    if event == "follow_up":
+        follow_up_scheduler.schedule(data["user_id"], data["due_at"])
+    elif event == "outbox":
+        delivery_queue.wake()
+    elif event == "broadcast":
+        broadcast_engine.wake()
+    elif event == "approve_pending":
+        task = asyncio.create_task(bulk_approve(**data))
+        worker_jobs.add(task)
+        task.add_done_callback(worker_jobs.discard)
+    else:
+        logger.warning("Unknown worker event: %s", event)
+
+async def main(queue=None):
+    """Start every tenant's bot and background services
+
+    queue is set in background worker processes and carries events from the
+    update-handling process.
+    """
+    global worker_pool
+    
+    # Debug environment variables
+    logger.info("MONGO_URI set: %s", 'Yes' if cfg.MONGO_URI else 'No')
+    
+    # Test database connection
+    await ping()
+    logger.info("✅ Database connection successful")
     
-    for usrs in allusers.find():
+    # Multi-tenant mode: BOT_OWNERS lists further namespaces served by this process
+    tenants = [primary_tenant] + load_extra_tenants()
+    tenants_by_owner = {tenant.owner: tenant for tenant in tenants}
+    primary_client = app._resolve()  # the Client itself rather than the proxy
+    instrument_handlers(primary_client)
+    for tenant in tenants[1:]:
+        await run_in_tenant(tenant, copy_handlers, primary_client)
+    
+    metrics_server = None
+    if cfg.METRICS_PORT:
         try:
-            userid = usrs["user_id"]
-            
-            # Check if the message contains [firstname] placeholder
-            if m.reply_to_message.text and "[firstname]" in m.reply_to_message.text:
-                # Try to get user's first name from onboarding data first
-                user_data = get_onboarding_user(userid)
-                first_name = "Friend"  # Default fallback
-                
-                if user_data and user_data.get("first_name"):
-                    first_name = user_data.get("first_name")
-                else:
-                    # Try to get first name from Telegram user object
-                    try:
-                        user = await app.get_users(int(userid))
-                        first_name = user.first_name or "Friend"
-                    except Exception:
-                        first_name = "Friend"
-                
-                # Ensure first_name is never None
-                if first_name is None:
-                    first_name = "Friend"
-                
-                # Replace [firstname] with actual first name
-                personalized_text = m.reply_to_message.text.replace("[firstname]", first_name)
-                
-                # Send personalized message (can't forward personalized content)
-                await app.send_message(
-                    int(userid),
-                    personalized_text,
-                    reply_markup=m.reply_to_message.reply_markup,
-                    disable_web_page_preview=True
-                )
-            else:
-                # Regular forward without personalization
-                await m.reply_to_message.forward(int(userid))
-            
-            success += 1
-        except FloodWait as ex:
-            await asyncio.sleep(ex.value)
-            # Retry with same personalization logic
-            if m.reply_to_message.text and "[firstname]" in m.reply_to_message.text:
-                user_data = get_onboarding_user(userid)
-                first_name = "Friend"  # Default fallback
-                
-                if user_data and user_data.get("first_name"):
-                    first_name = user_data.get("first_name")
-                else:
-                    try:
-                        user = await app.get_users(int(userid))
-                        first_name = user.first_name or "Friend"
-                    except Exception:
-                        first_name = "Friend"
-                
-                personalized_text = m.reply_to_message.text.replace("[firstname]", first_name)
-                await app.send_message(
-                    int(userid),
-                    personalized_text,
-                    reply_markup=m.reply_to_message.reply_markup,
-                    disable_web_page_preview=True
-                )
-            else:
-                await m.reply_to_message.forward(int(userid))
-        except errors.InputUserDeactivated:
-            deactivated += 1
-            remove_user(userid)
-        except errors.UserIsBlocked:
-            blocked += 1
-            remove_user(userid)
-        except errors.PeerIdInvalid:
-            failed += 1
-            logger.warning(f"User {userid} hasn't started the bot yet - skipping forward")
-        except Exception as e:
-            logger.error(f"Forward broadcast error: {str(e)}")
-            failed += 1
+            metrics_server = await metrics.serve(cfg.METRICS_HOST, cfg.METRICS_PORT)
+        except OSError as e:
+            # Metrics are optional; don't keep the bot from starting
+            logger.error("Could not serve metrics on %s:%s: %s", cfg.METRICS_HOST, cfg.METRICS_PORT, e)
     
-    result_text = (
-        f"✅ Successfully sent to `{success}` users.\n"
-        f"❌ Failed to send to `{failed}` users.\n"
-        f"👾 Found `{blocked}` blocked users\n"
-        f"👻 Found `{deactivated}` deactivated users."
-    )
+    # Move background work out of the update-handling process
+    if cfg.WORKER_ROLE == "all" and cfg.WORKER_PROCESSES > 0:
+        worker_pool = WorkerPool(worker_process, cfg.WORKER_PROCESSES)
+        worker_pool.start()
+        supervisor = asyncio.create_task(run_periodically(worker_pool.supervise, WORKER_SUPERVISE_SECONDS))
+    
+    async def dispatch(owner, event, data):
+        await run_in_tenant(tenants_by_owner[owner], handle_worker_event, event, data)
     
-    await lel.edit(result_text)
-    logger.info(f"Forward broadcast completed by admin {m.from_user.id}: {success} successful, {failed} failed")
+    started = []
+    try:
+        for tenant in tenants:
+            await run_in_tenant(tenant, start_tenant)
+            started.append(tenant)
+        logger.info("✅ Serving %s tenant(s): %s", len(tenants), ', '.join(t.owner for t in tenants))
+        if queue is None:
+            await idle()
+        else:
+            # Run until signalled or until the parent closes the queue
+            waiters = [asyncio.create_task(idle()), asyncio.create_task(consume(queue, dispatch))]
+            _, pending = await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+            for task in pending:
+                task.cancel()
+    finally:
+        if worker_pool is not None:
+            supervisor.cancel()
+            await asyncio.get_running_loop().run_in_executor(None, worker_pool.stop)
+        for task in worker_jobs:
+            task.cancel()
+        if metrics_server is not None:
+            metrics_server.close()
+        for tenant in started:
+            try:
+                await run_in_tenant(tenant, stop_tenant)
+            except Exception as e:
+                logger.error("Error stopping tenant %s: %s", tenant.owner, e)
 
+def worker_process(queue):
+    """Entry point of a background worker process (see WorkerPool)"""
+    app.run(main(queue))
 
 # Start the bot
 if __name__ == "__main__":
-    logger.info(f"Starting {cfg.BOT_NAME}...")
+    logger.info("Starting %s...", cfg.BOT_NAME)
     print(f"🤖 {cfg.BOT_NAME} is starting...")
     
     try:
-        # Debug environment variables
-        logger.info(f"MONGO_URI set: {'Yes' if cfg.MONGO_URI else 'No'}")
-        logger.info(f"DB_NAME: {cfg.DB_NAME}")
-        
-        # Test database connection
-        from database import client
-        client.admin.command('ping')
-        logger.info("✅ Database connection successful")
-        
-        # Start scheduler with improved job settings
-        scheduler.add_job(
-            process_follow_ups,
-            IntervalTrigger(seconds=30),  # Check every 30 seconds for testing
-            id='follow_up_processor',
-            replace_existing=True,
-            max_instances=3,  # Allow up to 3 concurrent instances
-            coalesce=True,  # Combine multiple pending executions
-            misfire_grace_time=30  # Grace time for missed executions
-        )
-        scheduler.start()
-        logger.info("Scheduler started")
-        
-        # Start bot
-        app.run()
+        app.run(main())
     except Exception as e:
-        logger.error(f"Error starting bot: {str(e)}")
+        logger.error("Error starting bot: %s", e)
         logger.exception("Full exception details:")
         print(f"❌ Error starting bot: {str(e)}")
     finally:
-        scheduler.shutdown()
         logger.info("Bot stopped.")
         print("🛑 Bot stopped.")
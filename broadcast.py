@@ -0,0 +1,238 @@
+import asyncio
+import logging
+import time
+from pyrogram import errors
+
+from database import (
+    all_users, remove_user, create_broadcast_job,
+    get_unfinished_broadcasts, get_broadcast_page, get_broadcast_delivered,
+    record_broadcast_page, finish_broadcast_shard, finish_broadcast_job
+)
+
+logger = logging.getLogger(__name__)
+
+COUNT_FIELDS = ("success", "failed", "blocked", "deactivated")
+
+# Telegram accepts at most 200 user IDs per users.getUsers call
+GET_USERS_BATCH = 200
+
+
+class BroadcastEngine:
+    """Concurrent, resumable delivery of /bcast and /fcast messages
+
+    A job is split into the user shards. Every worker runs the job for the
+    shards it has leased, walking each shard's users in _id order one page at
+    a time. Each page is fanned out over a bounded pool of workers whose sends
+    go through the rate limiter, and per-user results, the page's counts and
+    the shard cursor are persisted once the page is done. Jobs are picked up
+    by polling, so a job created by one process is delivered by all of them,
+    and an interrupted shard is resumed from its cursor; at most the page that
+    was in flight is re-sent.
+    """
+
+    def __init__(self, app, send, leases, workers=50, page_size=200, progress_interval=5, poll_interval=5):
+        self.app = app
+        self.send = send
+        self.leases = leases
+        self.workers = workers
+        self._semaphore = asyncio.Semaphore(workers)  # shared by every shard this process runs
+        self.page_size = page_size
+        self.progress_interval = progress_interval
+        self.poll_interval = poll_interval
+        self.tasks = set()
+        self._running = set()  # (job_id, shard) being delivered by this process
+        self._sources = {}  # job_id -> source message
+        self._last_progress = {}
+        self._wakeup = asyncio.Event()
+        self._poller = None
+
+    async def start(self, source, mode, status_message):
+        """Create a job for the replied message; the workers deliver it"""
+        job = await create_broadcast_job(
+            mode,
+            source.chat.id,
+            source.id,
+            status_message.chat.id,
+            status_message.id,
+            await all_users()
+        )
+        logger.info("Broadcast job %s created (%s, %s users)", job['_id'], mode, job['total'])
+        self._sources[job["_id"]] = source
+        self._wakeup.set()
+        return job
+
+    async def run(self):
+        """Deliver unfinished jobs in the leased shards until stopped"""
+        self.leases.on_gain(self._on_gain)
+        self._poller = asyncio.create_task(self._poll())
+
+    async def stop(self):
+        tasks = list(self.tasks) + ([self._poller] if self._poller else [])
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._poller = None
+
+    def wake(self):
+        """Look for new jobs now (e.g. after another process created one)"""
+        self._wakeup.set()
+
+    async def _on_gain(self, shards):
+        self._wakeup.set()
+
+    async def _poll(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                jobs = await get_unfinished_broadcasts()
+                for job in jobs:
+                    await self._spawn_shards(job)
+                # Forget jobs that have been completed
+                unfinished = {job["_id"] for job in jobs}
+                for job_id in [j for j in self._sources if j not in unfinished]:
+                    self._sources.pop(job_id, None)
+                    self._last_progress.pop(job_id, None)
+            except Exception as e:
+                logger.error("Error polling broadcast jobs: %s", e)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _spawn_shards(self, job):
+        done = set(job.get("done_shards", []))
+        shards = [s for s in sorted(self.leases.owned) if s not in done and (job["_id"], s) not in self._running]
+        if not shards:
+            return
+        source = self._sources.get(job["_id"])
+        if source is None:
+            try:
+                source = await self.app.get_messages(job["from_chat_id"], job["message_id"])
+            except Exception as e:
+                logger.error("Could not load the message of broadcast job %s: %s", job['_id'], e)
+                return
+            self._sources[job["_id"]] = source
+        for shard in shards:
+            logger.info("Delivering broadcast job %s to shard %s", job['_id'], shard)
+            self._running.add((job["_id"], shard))
+            task = asyncio.create_task(self._run_shard(job, shard, source))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _run_shard(self, job, shard, source):
+        cursor = job.get("cursors", {}).get(str(shard))
+        personalised = bool(source.text and "[firstname]" in source.text)
+        # First names resolved through Telegram, kept for the whole shard
+        names = {}
+
+        async def deliver(user_id):
+            async with self._semaphore:
+                return user_id, await self._deliver(job, source, user_id, names.get(user_id))
+
+        try:
+            while True:
+                if not self.leases.owns(shard):
+                    logger.info("Shard %s moved to another worker; leaving broadcast job %s to it", shard, job['_id'])
+                    return
+
+                page = await get_broadcast_page(shard, cursor, self.page_size, with_first_name=personalised)
+                if not page:
+                    break
+
+                user_ids = [doc["user_id"] for doc in page]
+                done = await get_broadcast_delivered(job["_id"], user_ids)
+                if personalised:
+                    for doc in page:
+                        if doc.get("first_name"):
+                            names[doc["user_id"]] = doc["first_name"]
+                    await self._resolve_names([uid for uid in user_ids if uid not in done], names)
+                results = await asyncio.gather(*[deliver(uid) for uid in user_ids if uid not in done])
+
+                statuses = dict(results)
+                counts = {field: 0 for field in COUNT_FIELDS}
+                for status in statuses.values():
+                    counts[status] += 1
+                cursor = page[-1]["_id"]
+                updated = await record_broadcast_page(job["_id"], shard, statuses, cursor, counts)
+
+                last = self._last_progress.get(job["_id"], 0)
+                if time.monotonic() - last >= self.progress_interval:
+                    self._last_progress[job["_id"]] = time.monotonic()
+                    await self._report(updated, final=False)
+
+            updated = await finish_broadcast_shard(job["_id"], shard)
+            if len(updated["done_shards"]) >= self.leases.shard_count and await finish_broadcast_job(job["_id"]):
+                await self._report(updated, final=True)
+                logger.info("Broadcast job %s completed: %s successful, %s failed", job['_id'], updated['success'], updated['failed'])
+        except Exception as e:
+            logger.error("Broadcast job %s stopped on shard %s: %s", job['_id'], shard, e)
+            logger.exception("Full exception details:")
+        finally:
+            self._running.discard((job["_id"], shard))
+
+    async def _deliver(self, job, source, user_id, first_name=None):
+        """Send the broadcast to one user and return the resulting status"""
+        try:
+            if source.text and "[firstname]" in source.text:
+                await self.send(
+                    self.app.send_message,
+                    int(user_id),
+                    source.text.replace("[firstname]", first_name or "Friend"),
+                    reply_markup=source.reply_markup,
+                    disable_web_page_preview=True
+                )
+            elif job["mode"] == "forward":
+                await self.send(source.forward, int(user_id))
+            else:
+                await self.send(source.copy, int(user_id))
+            return "success"
+        except errors.InputUserDeactivated:
+            await remove_user(user_id)
+            return "deactivated"
+        except errors.UserIsBlocked:
+            await remove_user(user_id)
+            return "blocked"
+        except errors.PeerIdInvalid:
+            logger.warning("User %s hasn't started the bot yet - skipping broadcast", user_id)
+            return "failed"
+        except Exception as e:
+            logger.error("Broadcast error for %s: %s", user_id, e)
+            return "failed"
+
+    async def _resolve_names(self, user_ids, names):
+        """Fill in first names missing from onboarding with batched get_users calls"""
+        unknown = [uid for uid in user_ids if uid not in names]
+        for i in range(0, len(unknown), GET_USERS_BATCH):
+            batch = unknown[i:i + GET_USERS_BATCH]
+            try:
+                found = await self.app.get_users([int(uid) for uid in batch])
+                for user in found:
+                    names[str(user.id)] = user.first_name or "Friend"
+            except Exception as e:
+                logger.warning("Could not resolve %s first names: %s", len(batch), e)
+            # Don't ask Telegram again for users it couldn't return
+            for uid in batch:
+                names.setdefault(uid, "Friend")
+
+    async def _report(self, job, final):
+        counts = {field: job.get(field, 0) for field in COUNT_FIELDS}
+        if final:
+            text = (
+                f"✅ Successfully sent to `{counts['success']}` users.\n"
+                f"❌ Failed to send to `{counts['failed']}` users.\n"
+                f"👾 Found `{counts['blocked']}` blocked users\n"
+                f"👻 Found `{counts['deactivated']}` deactivated users."
+            )
+        else:
+            processed = sum(counts.values())
+            text = (
+                f"`⚡️ Broadcasting... {processed}/{job['total']}`\n\n"
+                f"✅ Sent: `{counts['success']}`\n"
+                f"❌ Failed: `{counts['failed']}`\n"
+                f"👾 Blocked: `{counts['blocked']}`\n"
+                f"👻 Deactivated: `{counts['deactivated']}`"
+            )
+        try:
+            await self.app.edit_message_text(job["admin_chat_id"], job["status_message_id"], text)
+        except Exception as e:
+            logger.warning("Could not update broadcast progress: %s", e)
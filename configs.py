@@ -1,15 +1,84 @@
 import os
 import json
-from typing import List
+from string import Formatter
+from typing import Dict, List
 from pathlib import Path
+from tenants import Tenant, TenantProxy, get_tenant, set_default_tenant
+
+class MessageTemplate:
+    """Message text with its static placeholders already filled in
+
+    The text is parsed once; static values are substituted at load time and
+    only the per-message fields (e.g. first_name) are filled by render().
+    Unknown placeholders raise ValueError when the template is built.
+    """
+    
+    _formatter = Formatter()
+    
+    def __init__(self, name: str, text: str, static: Dict[str, str], dynamic: List[str]):
+        self.name = name
+        self.parts = []  # literal strings and (field, conversion, spec) tuples
+        literal = []
+        
+        try:
+            parsed = list(self._formatter.parse(text))
+        except ValueError as e:
+            raise ValueError(f"Template '{name}' is malformed: {e}")
+        
+        for text_part, field, spec, conversion in parsed:
+            literal.append(text_part)
+            if field is None:
+                continue
+            if field in static:
+                value = self._formatter.convert_field(static[field], conversion)
+                literal.append(self._formatter.format_field(value, spec))
+            elif field in dynamic:
+                self.parts.append("".join(literal))
+                literal = []
+                self.parts.append((field, conversion, spec))
+            else:
+                allowed = ", ".join(sorted(list(static) + list(dynamic)))
+                raise ValueError(f"Template '{name}' uses unknown placeholder {{{field}}} (allowed: {allowed})")
+        self.parts.append("".join(literal))
+        self.parts = [part for part in self.parts if part != ""]
+    
+    def render(self, **values) -> str:
+        """Fill in the per-message fields"""
+        out = []
+        for part in self.parts:
+            if isinstance(part, str):
+                out.append(part)
+            else:
+                field, conversion, spec = part
+                value = self._formatter.convert_field(values[field], conversion)
+                out.append(self._formatter.format_field(value, spec))
+        return "".join(out)
+
+# Per-message placeholders each template may use, in addition to the static ones
+TEMPLATE_FIELDS = {
+    "welcome_message": ["first_name"],
+    "immediate_follow_up": [],
+    "setup_instructions": ["first_name"],
+    "support_message": [],
+    "follow_up_1h": ["whatsapp_link"],
+    "follow_up_3h": ["first_name"],
+    "setup_completed_msg": [],
+    "setup_reminder_msg": []
+}
 
 class Config:
-    def __init__(self):
+    def __init__(self, owner: str = None):
+        # Extra tenants read their own BOT_TOKEN/CHID/SUDO/DB_NAME from <OWNER>_* variables
+        self._owner = owner
+        
         # Load JSON configuration first
         self._load_json_config()
         
         # Load environment variables (required)
         self._load_env_config()
+        
+        # Pre-render and validate message templates
+        self._compile_templates()
     
     def _load_json_config(self):
         """Load configuration from JSON file"""
@@ -26,32 +95,70 @@ class Config:
             print("⚠️ No config.json found, using environment variables and defaults")
             self.json_config = {}
     
+    def _tenant_env(self, name: str, default: str = None):
+        """Read a per-bot variable (prefixed with the owner for extra tenants)"""
+        if self._owner:
+            return os.getenv(f"{self._owner.upper()}_{name}", default)
+        return os.getenv(name, default)
+    
     def _load_env_config(self):
         """Load environment variables"""
         # Required environment variables
         self.API_ID: int = int(os.getenv("API_ID", "0"))
         self.API_HASH: str = os.getenv("API_HASH", "")
-        self.BOT_TOKEN: str = os.getenv("BOT_TOKEN", "")
+        self.BOT_TOKEN: str = self._tenant_env("BOT_TOKEN", "")
         
         # Force Subscribe Channel ID
-        self.CHID: int = int(os.getenv("CHID", "0"))
+        self.CHID: int = int(self._tenant_env("CHID", "0"))
+        # Make /start check that the user is in the channel and hand out an invite link if not
+        self.REQUIRE_CHANNEL_MEMBERSHIP: bool = self._tenant_env("REQUIRE_CHANNEL_MEMBERSHIP", "false").lower() in ("1", "true", "yes")
         
         # Admin/Owner User IDs (can be comma-separated)
         self.SUDO: List[int] = []
-        if os.getenv("SUDO"):
-            self.SUDO = [int(x.strip()) for x in os.getenv("SUDO").split(",")]
+        if self._tenant_env("SUDO"):
+            self.SUDO = [int(x.strip()) for x in self._tenant_env("SUDO").split(",")]
+        
+        # Bot Owner Configuration
+        self.BOT_OWNER: str = self._owner or os.getenv("BOT_OWNER", "graceboy")
         
-        # Database Configuration
+        # Database Configuration (one Mongo connection, one database per tenant)
         self.MONGO_URI: str = os.getenv("MONGO_URI", "")
-        self.DB_NAME: str = os.getenv("DB_NAME", "main")
+        self.DB_NAME: str = self._tenant_env("DB_NAME", "main" if not self._owner else self._owner)
         
-        # Bot Owner Configuration
-        self.BOT_OWNER: str = os.getenv("BOT_OWNER", "graceboy")
+        # Pyrogram session storage: "mongo" keeps the session in the database,
+        # "file" keeps it in SESSIONS_DIR (use a persistent volume)
+        self.SESSION_STORAGE: str = os.getenv("SESSION_STORAGE", "mongo").lower()
+        self.SESSIONS_DIR: str = os.getenv("SESSIONS_DIR", "/tmp/sessions")
+        
+        # Process role: "all" handles updates and background work, "updates" only
+        # handles the Telegram update stream, "worker" only runs background work
+        self.WORKER_ROLE: str = os.getenv("WORKER_ROLE", "all").lower()
+        
+        # Background work is split by user_id into shards leased by the running workers
+        self.SHARD_COUNT: int = int(os.getenv("SHARD_COUNT", "16"))
+        self.SHARD_LEASE_SECONDS: int = int(os.getenv("SHARD_LEASE_SECONDS", "30"))
+        
+        # With WORKER_ROLE=all, number of local worker processes to spawn for the background work
+        self.WORKER_PROCESSES: int = int(os.getenv("WORKER_PROCESSES", "0"))
+        
+        # Prometheus metrics endpoint, off unless a port is set; local worker
+        # processes listen on the following ports, one each
+        self.METRICS_HOST: str = os.getenv("METRICS_HOST", "127.0.0.1")
+        self.METRICS_PORT: int = int(os.getenv("METRICS_PORT", "0"))
+        if self.METRICS_PORT and os.getenv("WORKER_INDEX") is not None:
+            self.METRICS_PORT += 1 + int(os.getenv("WORKER_INDEX"))
+        
+        # Logging: level (DEBUG shows the per-user trace lines), "text" or "json"
+        # output, and how many records per second each message may log (0 = no limit)
+        self.LOG_LEVEL: str = os.getenv("LOG_LEVEL", "INFO").upper()
+        self.LOG_FORMAT: str = os.getenv("LOG_FORMAT", "text").lower()
+        self.LOG_RATE_LIMIT: int = int(os.getenv("LOG_RATE_LIMIT", "20"))
         
         # Load configuration from JSON using bot owner namespace
         owner_config = self.json_config.get(self.BOT_OWNER, {})
         bot_config = owner_config.get("bot_config", {})
         timing_config = owner_config.get("timing", {})
+        rate_limits_config = owner_config.get("rate_limits", {})
         messages_config = owner_config.get("messages", {})
         
         if not owner_config:
@@ -77,6 +184,14 @@ class Config:
         self.FOLLOW_UP_1_MINUTES: int = timing_config.get("follow_up_1_minutes", int(os.getenv("FOLLOW_UP_1_MINUTES", "1")))
         self.FOLLOW_UP_3_MINUTES: int = timing_config.get("follow_up_3_minutes", int(os.getenv("FOLLOW_UP_3_MINUTES", "3")))
         
+        # Send Rate Limits (Telegram allows ~30 msg/s overall and ~1 msg/s per chat)
+        self.GLOBAL_SEND_RATE: float = float(rate_limits_config.get("global_per_second", os.getenv("GLOBAL_SEND_RATE", "25")))
+        self.GLOBAL_SEND_BURST: float = float(rate_limits_config.get("global_burst", os.getenv("GLOBAL_SEND_BURST", "25")))
+        self.PER_CHAT_SEND_RATE: float = float(rate_limits_config.get("per_chat_per_second", os.getenv("PER_CHAT_SEND_RATE", "1")))
+        self.PER_CHAT_SEND_BURST: float = float(rate_limits_config.get("per_chat_burst", os.getenv("PER_CHAT_SEND_BURST", "1")))
+        self.DELIVERY_WORKERS: int = int(rate_limits_config.get("delivery_workers", os.getenv("DELIVERY_WORKERS", "20")))
+        self.BROADCAST_WORKERS: int = int(rate_limits_config.get("broadcast_workers", os.getenv("BROADCAST_WORKERS", "50")))
+        
         # Custom Messages
         self.WELCOME_MESSAGE: str = messages_config.get("welcome_message", os.getenv("WELCOME_MESSAGE", """Welcome, {first_name}!
 
@@ -160,6 +275,30 @@ Don't forget the promo code: {promo_code} for up to 150% bonus.
 
 After funding, send proof to @{support_username} so we activate the bot for you."""))
     
+    def _compile_templates(self):
+        """Build a MessageTemplate for every message, failing fast on bad placeholders"""
+        static = {
+            "bot_name": self.BOT_NAME,
+            "channel_url": self.CHANNEL_URL,
+            "support_url": self.SUPPORT_URL,
+            "deposit_guide_link": self.DEPOSIT_GUIDE_LINK,
+            "results_channel_link": self.RESULTS_CHANNEL_LINK,
+            "support_username": self.SUPPORT_USERNAME,
+            "direct_contact_username": self.DIRECT_CONTACT_USERNAME,
+            "promo_code": self.PROMO_CODE
+        }
+        
+        self.templates: Dict[str, MessageTemplate] = {}
+        errors = []
+        for name, fields in TEMPLATE_FIELDS.items():
+            try:
+                self.templates[name] = MessageTemplate(name, getattr(self, name.upper()), static, fields)
+            except ValueError as e:
+                errors.append(str(e))
+        
+        if errors:
+            raise ValueError("Invalid message templates: " + "; ".join(errors))
+    
     def validate(self):
         """Validate that all required environment variables are set"""
         errors = []
@@ -182,13 +321,48 @@ After funding, send proof to @{support_username} so we activate the bot for you.
         if not self.MONGO_URI:
             errors.append("MONGO_URI is required")
         
+        if self.WORKER_ROLE not in ("all", "updates", "worker"):
+            errors.append("WORKER_ROLE must be one of all, updates, worker")
+        
+        if self.SESSION_STORAGE not in ("mongo", "file"):
+            errors.append("SESSION_STORAGE must be mongo or file")
+        
+        if self.LOG_LEVEL not in ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"):
+            errors.append("LOG_LEVEL must be one of DEBUG, INFO, WARNING, ERROR, CRITICAL")
+        
+        if self.LOG_FORMAT not in ("text", "json"):
+            errors.append("LOG_FORMAT must be text or json")
+        
+        if self.SHARD_COUNT < 1:
+            errors.append("SHARD_COUNT must be at least 1")
+        
         if errors:
-            raise ValueError(f"Missing required environment variables: {', '.join(errors)}")
+            raise ValueError(f"Invalid environment variables: {', '.join(errors)}")
         
         return True
 
+def load_extra_tenants() -> List[Tenant]:
+    """Tenants listed in BOT_OWNERS besides BOT_OWNER (multi-tenant mode)"""
+    owners = [x.strip() for x in os.getenv("BOT_OWNERS", "").split(",") if x.strip()]
+    tenants = []
+    for owner in owners:
+        if owner == primary_tenant.owner:
+            continue
+        config = Config(owner)
+        config.validate()
+        tenants.append(Tenant(config))
+    
+    db_names = [t.cfg.DB_NAME for t in tenants] + [primary_tenant.cfg.DB_NAME]
+    if len(set(db_names)) != len(db_names):
+        raise ValueError(f"Each tenant needs its own DB_NAME, got: {', '.join(db_names)}")
+    return tenants
+
 # Create and validate configuration
-cfg = Config()
-cfg.validate()
+primary_tenant = Tenant(Config())
+primary_tenant.cfg.validate()
+set_default_tenant(primary_tenant)
+
+# Configuration of the tenant being served (the BOT_OWNER one outside tenant tasks)
+cfg = TenantProxy(lambda: get_tenant().cfg)
 
 
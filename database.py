@@ -1,141 +1,1042 @@
-from pymongo import MongoClient
+import asyncio
+import functools
+import logging
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pymongo import MongoClient, ASCENDING, ReturnDocument, UpdateOne, ReplaceOne
+from pymongo.errors import DuplicateKeyError, OperationFailure
 from configs import cfg
+from tenants import tenant_local
+import metrics
 from datetime import datetime, timedelta
 import pytz
 
-client = MongoClient(cfg.MONGO_URI)
+try:
+    from motor.motor_asyncio import AsyncIOMotorClient
+except ImportError:
+    AsyncIOMotorClient = None
 
-users = client[cfg.DB_NAME]['users']
-groups = client[cfg.DB_NAME]['groups']
-onboarding = client[cfg.DB_NAME]['onboarding']
-settings = client[cfg.DB_NAME]['settings']
+logger = logging.getLogger(__name__)
 
-def already_db(user_id):
-        user = users.find_one({"user_id" : str(user_id)})
-        if not user:
-            return False
-        return True
+# Threads used to run blocking pymongo calls when Motor is not installed
+DB_THREADS = 16
 
-def already_dbg(chat_id):
-        group = groups.find_one({"chat_id" : str(chat_id)})
-        if not group:
-            return False
-        return True
+# Seconds that onboarding field updates are buffered before being written
+WRITE_BEHIND_INTERVAL = 0.25
 
-def add_user(user_id):
-    in_db = already_db(user_id)
-    if in_db:
+# In-process cache of onboarding records: entries kept and seconds they stay fresh
+ONBOARDING_CACHE_SIZE = 50000
+ONBOARDING_CACHE_TTL = 60
+
+
+def _timed(func):
+    """Record the latency of a database function (bot_db_seconds)"""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        with metrics.db_latency.time(tenant=cfg.BOT_OWNER, function=func.__name__):
+            return await func(*args, **kwargs)
+    return wrapper
+
+
+class _ThreadedCursor:
+    """Async iterator over a pymongo cursor, fetching documents in a worker thread"""
+
+    def __init__(self, executor, factory, batch_size=100):
+        self._executor = executor
+        self._factory = factory
+        self._batch_size = batch_size
+        self._cursor = None
+        self._buffer = []
+        self._exhausted = False
+
+    def _fetch_batch(self):
+        if self._cursor is None:
+            self._cursor = self._factory()
+        batch = []
+        for doc in self._cursor:
+            batch.append(doc)
+            if len(batch) >= self._batch_size:
+                break
+        return batch
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self._buffer:
+            if self._exhausted:
+                raise StopAsyncIteration
+            loop = asyncio.get_running_loop()
+            self._buffer = await loop.run_in_executor(self._executor, self._fetch_batch)
+            if len(self._buffer) < self._batch_size:
+                self._exhausted = True
+            if not self._buffer:
+                raise StopAsyncIteration
+        return self._buffer.pop(0)
+
+    async def to_list(self, length=None):
+        docs = []
+        async for doc in self:
+            docs.append(doc)
+            if length and len(docs) >= length:
+                break
+        return docs
+
+
+class _ThreadedCollection:
+    """Motor-compatible facade over a pymongo collection backed by a thread pool"""
+
+    def __init__(self, collection, executor):
+        self._collection = collection
+        self._executor = executor
+
+    def find(self, *args, **kwargs):
+        return _ThreadedCursor(
+            self._executor,
+            functools.partial(self._collection.find, *args, **kwargs),
+            kwargs.get("batch_size") or 100
+        )
+
+    def aggregate(self, pipeline, **kwargs):
+        return _ThreadedCursor(
+            self._executor,
+            functools.partial(self._collection.aggregate, pipeline, **kwargs),
+            kwargs.get("batchSize") or 100
+        )
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if not callable(attr):
+            return attr
+
+        async def call(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, functools.partial(attr, *args, **kwargs))
+
+        return call
+
+
+class _TTLCache:
+    """LRU cache whose entries also expire `ttl` seconds after being stored"""
+
+    def __init__(self, maxsize, ttl):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        expires, value = entry
+        if expires < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self._ttl, value)
+        self._data.move_to_end(key)
+        if len(self._data) > self._maxsize:
+            self._data.popitem(last=False)
+
+    def update(self, key, fields):
+        """Apply fields to a cached document, if there is one"""
+        entry = self._data.get(key)
+        if entry is not None and entry[1] is not None:
+            entry[1].update(fields)
+
+    def pop(self, key):
+        self._data.pop(key, None)
+
+
+class _WriteBehindBuffer:
+    """Coalesces $set updates per user_id and writes them with one bulk_write
+
+    The first update after a flush schedules the next flush `interval` seconds
+    later; further updates in that window are merged into the same batch.
+    Flushes run one at a time, so once flush() returns every update buffered
+    before the call has been written, including a batch another caller was
+    already writing.
+    """
+
+    def __init__(self, collection, interval):
+        self._collection = collection
+        self._interval = interval
+        self._pending = {}
+        self._task = None
+        self._lock = asyncio.Lock()
+
+    def set(self, user_id, fields):
+        self._pending.setdefault(str(user_id), {}).update(fields)
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._flush_later())
+
+    def discard(self, user_id):
+        """Drop buffered updates for a user whose record is being replaced"""
+        self._pending.pop(str(user_id), None)
+
+    def overlay(self, doc):
+        """Apply buffered updates to a document read from the database"""
+        if doc is not None:
+            doc.update(self._pending.get(doc["user_id"], {}))
+        return doc
+
+    async def _flush_later(self):
+        await asyncio.sleep(self._interval)
+        try:
+            await self.flush()
+        except Exception:
+            # Failed updates were kept; try again after another interval
+            self._task = asyncio.get_running_loop().create_task(self._flush_later())
+
+    async def flush(self):
+        async with self._lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, {}
+            try:
+                await self._collection.bulk_write(
+                    [UpdateOne({"user_id": user_id}, {"$set": fields}) for user_id, fields in batch.items()],
+                    ordered=False
+                )
+            except Exception as e:
+                logger.error("Error writing %s buffered onboarding updates: %s", len(batch), e)
+                # Keep the failed updates, without overriding anything newer
+                for user_id, fields in batch.items():
+                    self._pending[user_id] = {**fields, **self._pending.get(user_id, {})}
+                raise
+
+
+# One connection pool for the process; every tenant gets its own database
+# (cfg.DB_NAME), and the names below resolve to the current tenant's objects.
+if AsyncIOMotorClient is not None:
+    client = AsyncIOMotorClient(cfg.MONGO_URI)
+
+    def _collection(name):
+        return tenant_local(lambda: client[cfg.DB_NAME].get_collection(name))
+else:
+    _executor = ThreadPoolExecutor(max_workers=DB_THREADS, thread_name_prefix="mongo")
+    client = MongoClient(cfg.MONGO_URI)
+
+    def _collection(name):
+        return tenant_local(lambda: _ThreadedCollection(client[cfg.DB_NAME][name], _executor))
+
+db = tenant_local(lambda: client[cfg.DB_NAME])
+users = _collection('users')
+groups = _collection('groups')
+onboarding = _collection('onboarding')
+settings = _collection('settings')
+broadcasts = _collection('broadcasts')
+broadcast_status = _collection('broadcast_status')
+outbox = _collection('outbox')
+dead_letters = _collection('dead_letters')
+shards = _collection('shards')
+sessions = _collection('sessions')
+peers = _collection('peers')
+
+onboarding_writes = tenant_local(lambda: _WriteBehindBuffer(onboarding, WRITE_BEHIND_INTERVAL))
+
+# Onboarding records by user_id (users without a record are not cached)
+_MISSING = object()
+onboarding_cache = tenant_local(lambda: _TTLCache(ONBOARDING_CACHE_SIZE, ONBOARDING_CACHE_TTL))
+
+@_timed
+async def ping():
+    """Check that the database is reachable"""
+    if AsyncIOMotorClient is not None:
+        return await client.admin.command('ping')
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, client.admin.command, 'ping')
+
+def _duplicate_groups(collection, field):
+    """Cursor over values of field held by more than one document, newest _id first"""
+    return collection.aggregate([
+        {"$sort": {"_id": -1}},
+        {"$group": {"_id": f"${field}", "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}}
+    ], allowDiskUse=True)
+
+async def _remove_duplicates(collection, field):
+    """Keep only the newest document for each value of field; returns the number deleted"""
+    removed = 0
+    async for group in _duplicate_groups(collection, field):
+        result = await collection.delete_many({"_id": {"$in": group["ids"][1:]}})
+        removed += result.deleted_count
+    return removed
+
+async def _ensure_unique_index(collection, field):
+    """Create a unique index on field, replacing an older non-unique one
+
+    Nothing is deleted here: if the collection still has duplicates the old
+    index is kept and migrate_unique_indexes() (python migrate.py) has to be
+    run once.
+    """
+    name = f"{field}_1"
+    info = await collection.index_information()
+    if info.get(name, {}).get("unique"):
         return
-    return users.insert_one({"user_id": str(user_id)}) 
-
-def remove_user(user_id):
-    in_db = already_db(user_id)
-    if not in_db:
-        return 
-    return users.delete_one({"user_id": str(user_id)})
-    
-def add_group(chat_id):
-    in_db = already_dbg(chat_id)
-    if in_db:
+    async for _ in _duplicate_groups(collection, field):
+        logger.error(
+            "%s has duplicate %s values, so its index is not unique yet; run `python migrate.py` to fix it",
+            collection.name, field
+        )
         return
-    return groups.insert_one({"chat_id": str(chat_id)})
+    if name in info:
+        try:
+            await collection.drop_index(name)
+        except OperationFailure:
+            # Another process starting at the same time already dropped it
+            pass
+    await collection.create_index(field, unique=True)
+
+@_timed
+async def migrate_unique_indexes():
+    """Remove duplicate users, groups and onboarding records and make their indexes unique"""
+    for collection, field in ((users, "user_id"), (groups, "chat_id"), (onboarding, "user_id")):
+        removed = await _remove_duplicates(collection, field)
+        logger.info("Removed %s duplicate documents from %s", removed, collection.name)
+        await _ensure_unique_index(collection, field)
+
+def shard_of(user_id):
+    """Shard that owns a user's background work"""
+    return int(user_id) % cfg.SHARD_COUNT
+
+@_timed
+async def ensure_indexes():
+    """Create the indexes the bot's queries rely on"""
+    await _ensure_unique_index(users, "user_id")
+    await _ensure_unique_index(groups, "chat_id")
+    await _ensure_unique_index(onboarding, "user_id")
+    await broadcast_status.create_index([("job_id", ASCENDING), ("user_id", ASCENDING)])
+    await broadcasts.create_index("status")
+    # Follow-ups are found by next_follow_up_at now; drop the indexes of the old scan
+    info = await onboarding.index_information()
+    for follow_up_type in ("1h", "3h"):
+        name = f"follow_up_{follow_up_type}_sent_1_setup_completed_1_created_at_1"
+        if name in info:
+            await onboarding.drop_index(name)
+    await onboarding.create_index("next_follow_up_at")
+    await outbox.create_index([("status", ASCENDING), ("not_before", ASCENDING)])
+    await users.create_index([("shard", ASCENDING), ("_id", ASCENDING)])
+    await onboarding.create_index([("shard", ASCENDING), ("next_follow_up_at", ASCENDING)])
+    await peers.create_index("username")
+    await peers.create_index("usernames")
+    await peers.create_index("phone_number")
+
+@_timed
+async def ensure_shard_layout():
+    """Tag users and onboarding records with their shard
+
+    Only untagged documents are touched, unless SHARD_COUNT changed since the
+    last run, in which case every document is re-tagged.
+    """
+    layout = await shards.find_one({"_id": "layout"})
+    query = {"shard": {"$exists": False}}
+    if not layout or layout.get("count") != cfg.SHARD_COUNT:
+        query = {}
+    pipeline = [{"$set": {"shard": {"$mod": [{"$toLong": "$user_id"}, cfg.SHARD_COUNT]}}}]
+    await users.update_many(query, pipeline)
+    await onboarding.update_many(query, pipeline)
+    await shards.update_one({"_id": "layout"}, {"$set": {"count": cfg.SHARD_COUNT}}, upsert=True)
+
+@_timed
+async def already_db(user_id):
+    user = await users.find_one({"user_id": str(user_id)})
+    if not user:
+        return False
+    return True
+
+@_timed
+async def already_dbg(chat_id):
+    group = await groups.find_one({"chat_id": str(chat_id)})
+    if not group:
+        return False
+    return True
+
+@_timed
+async def add_user(user_id):
+    return await users.update_one(
+        {"user_id": str(user_id)},
+        {"$setOnInsert": {"user_id": str(user_id), "shard": shard_of(user_id)}},
+        upsert=True
+    )
+
+@_timed
+async def remove_user(user_id):
+    return await users.delete_one({"user_id": str(user_id)})
+
+@_timed
+async def add_group(chat_id):
+    return await groups.update_one(
+        {"chat_id": str(chat_id)},
+        {"$setOnInsert": {"chat_id": str(chat_id)}},
+        upsert=True
+    )
+
+@_timed
+async def all_users():
+    return await users.estimated_document_count()
+
+@_timed
+async def all_groups():
+    return await groups.estimated_document_count()
 
-def all_users():
-    user = users.find({})
-    usrs = len(list(user))
-    return usrs
+# Stats snapshot served by /users, refreshed in the background
+stats_snapshot = tenant_local(lambda: {"users": 0, "groups": 0, "funnel": {}, "updated_at": None})
 
-def all_groups():
-    group = groups.find({})
-    grps = len(list(group))
-    return grps
+@_timed
+async def get_onboarding_funnel():
+    """Count onboarding records per stage"""
+    counts = onboarding.aggregate([
+        {"$group": {"_id": "$onboarding_stage", "count": {"$sum": 1}}}
+    ])
+    return {doc["_id"]: doc["count"] async for doc in counts}
+
+@_timed
+async def refresh_stats():
+    """Recompute the stats snapshot"""
+    user_count, group_count, funnel = await asyncio.gather(
+        all_users(), all_groups(), get_onboarding_funnel()
+    )
+    stats_snapshot.update({
+        "users": user_count,
+        "groups": group_count,
+        "funnel": funnel,
+        "updated_at": datetime.now(pytz.UTC)
+    })
+    return stats_snapshot
 
 # Onboarding functions
-def add_onboarding_user(user_id, first_name):
-    """Add user to onboarding tracking with their first name"""
+def _new_onboarding_record(user_id, first_name):
     utc = pytz.UTC
     now = datetime.now(utc)
-    
-    return onboarding.insert_one({
+
+    return {
         "user_id": str(user_id),
+        "shard": shard_of(user_id),
         "first_name": first_name,
         "onboarding_stage": "welcome_sent",
         "created_at": now,
+        "next_follow_up_at": now + timedelta(minutes=cfg.FOLLOW_UP_1_MINUTES),
         "follow_up_1h_sent": False,
         "follow_up_3h_sent": False,
         "setup_completed": False,
         "account_verified": False
-    })
+    }
 
-def get_onboarding_user(user_id):
-    """Get onboarding data for a user"""
-    return onboarding.find_one({"user_id": str(user_id)})
+@_timed
+async def add_onboarding_user(user_id, first_name):
+    """Start (or restart) onboarding tracking for a user with their first name"""
+    record = _new_onboarding_record(user_id, first_name)
+    onboarding_writes.discard(user_id)
+    onboarding_cache.set(str(user_id), dict(record))
+    return await onboarding.replace_one({"user_id": str(user_id)}, record, upsert=True)
 
-def update_onboarding_stage(user_id, stage):
-    """Update user's onboarding stage"""
-    return onboarding.update_one(
-        {"user_id": str(user_id)},
+@_timed
+async def create_onboarding_user(user_id, first_name):
+    """Start onboarding tracking for a user who has no record yet
+
+    Returns True only if this call created the record, so when several
+    processes see the same new user just one of them onboards it.
+    """
+    record = _new_onboarding_record(user_id, first_name)
+    try:
+        result = await onboarding.update_one({"user_id": str(user_id)}, {"$setOnInsert": record}, upsert=True)
+    except DuplicateKeyError:
+        return False
+    if result.upserted_id is None:
+        return False
+    onboarding_cache.set(str(user_id), dict(record))
+    return True
+
+@_timed
+async def register_join(user_id, first_name=None, chat_id=None):
+    """Record a user, optionally the group they joined, and a fresh onboarding record
+
+    The upserts go to different collections, so they are issued concurrently
+    rather than one after another. Onboarding is skipped when first_name is None.
+    """
+    ops = [add_user(user_id)]
+    if chat_id is not None:
+        ops.append(add_group(chat_id))
+    if first_name is not None:
+        ops.append(add_onboarding_user(user_id, first_name))
+    return await asyncio.gather(*ops)
+
+@_timed
+async def register_joins(members, chat_id=None):
+    """Bulk register_join for a page of (user_id, first_name) pairs
+
+    Users and fresh onboarding records are each written with one bulk_write;
+    members whose first_name is None get no onboarding record.
+    """
+    if not members:
+        return
+    ops = [users.bulk_write([
+        UpdateOne({"user_id": str(user_id)}, {"$setOnInsert": {"user_id": str(user_id), "shard": shard_of(user_id)}}, upsert=True)
+        for user_id, _ in members
+    ], ordered=False)]
+    if chat_id is not None:
+        ops.append(add_group(chat_id))
+    records = [_new_onboarding_record(user_id, first_name) for user_id, first_name in members if first_name is not None]
+    if records:
+        for record in records:
+            onboarding_writes.discard(record["user_id"])
+            onboarding_cache.set(record["user_id"], dict(record))
+        ops.append(onboarding.bulk_write([
+            ReplaceOne({"user_id": record["user_id"]}, record, upsert=True)
+            for record in records
+        ], ordered=False))
+    return await asyncio.gather(*ops)
+
+@_timed
+async def get_onboarding_user(user_id):
+    """Get onboarding data for a user (served from the cache when fresh)
+
+    Misses are not cached, so a record another process has just created is
+    seen on the next call.
+    """
+    key = str(user_id)
+    doc = onboarding_cache.get(key, _MISSING)
+    if doc is _MISSING:
+        doc = onboarding_writes.overlay(await onboarding.find_one({"user_id": key}))
+        if doc is not None:
+            onboarding_cache.set(key, doc)
+    return dict(doc) if doc is not None else None
+
+def _set_onboarding_fields(user_id, fields):
+    """Buffer an onboarding update and apply it to the cached record"""
+    onboarding_writes.set(user_id, fields)
+    onboarding_cache.update(str(user_id), fields)
+
+@_timed
+async def update_onboarding_stage(user_id, stage, only_from=None):
+    """Update user's onboarding stage (buffered)
+
+    With only_from, the stage is written straight away and only if the record
+    is still at one of those stages.
+    """
+    if only_from is None:
+        _set_onboarding_fields(user_id, {"onboarding_stage": stage})
+        return
+    # A newer stage may still be sitting in the write-behind buffer
+    await flush_onboarding_updates()
+    result = await onboarding.update_one(
+        {"user_id": str(user_id), "onboarding_stage": {"$in": list(only_from)}},
         {"$set": {"onboarding_stage": stage}}
     )
+    if result.modified_count:
+        onboarding_cache.update(str(user_id), {"onboarding_stage": stage})
+    else:
+        # Our copy may be stale; read it again next time
+        onboarding_cache.pop(str(user_id))
 
-def mark_follow_up_sent(user_id, follow_up_type):
-    """Mark a follow-up as sent"""
+@_timed
+async def mark_follow_up_sent(user_id, follow_up_type):
+    """Mark a follow-up as sent (written straight away: advance_follow_up reads it back)"""
     field = f"follow_up_{follow_up_type}_sent"
-    return onboarding.update_one(
-        {"user_id": str(user_id)},
-        {"$set": {field: True}}
+    onboarding_cache.update(str(user_id), {field: True})
+    return await onboarding.update_one({"user_id": str(user_id)}, {"$set": {field: True}})
+
+@_timed
+async def mark_setup_completed(user_id, completed=True):
+    """Mark user's setup as completed (buffered)"""
+    update = {"setup_completed": completed}
+    if completed:
+        # Completed users get no further follow-ups
+        update["next_follow_up_at"] = None
+    _set_onboarding_fields(user_id, update)
+
+@_timed
+async def mark_account_verified(user_id, verified=True):
+    """Mark user's account as verified (buffered)"""
+    _set_onboarding_fields(user_id, {"account_verified": verified})
+
+@_timed
+async def flush_onboarding_updates():
+    """Write any buffered onboarding updates now"""
+    await onboarding_writes.flush()
+
+def _next_follow_up_expr():
+    """Aggregation expression computing when a user's next follow-up is due"""
+    return {"$switch": {
+        "branches": [
+            {"case": {"$eq": ["$setup_completed", True]}, "then": None},
+            {"case": {"$ne": ["$follow_up_1h_sent", True]},
+             "then": {"$add": ["$created_at", cfg.FOLLOW_UP_1_MINUTES * 60000]}},
+            {"case": {"$ne": ["$follow_up_3h_sent", True]},
+             "then": {"$add": ["$created_at", cfg.FOLLOW_UP_3_MINUTES * 60000]}}
+        ],
+        "default": None
+    }}
+
+@_timed
+async def backfill_next_follow_ups():
+    """Compute next_follow_up_at for onboarding records created before it existed"""
+    return await onboarding.update_many(
+        {"next_follow_up_at": {"$exists": False}},
+        [{"$set": {"next_follow_up_at": _next_follow_up_expr()}}]
     )
 
-def mark_setup_completed(user_id, completed=True):
-    """Mark user's setup as completed"""
-    return onboarding.update_one(
-        {"user_id": str(user_id)},
-        {"$set": {"setup_completed": completed}}
+def get_scheduled_follow_ups(shard_ids, due_before=None):
+    """Get pending follow-ups in the given shards (async cursor of user_id/next_follow_up_at)
+
+    With due_before, only follow-ups due by then are returned.
+    """
+    due = {"$type": "date"}
+    if due_before is not None:
+        due["$lte"] = due_before
+    return onboarding.find(
+        {"shard": {"$in": list(shard_ids)}, "next_follow_up_at": due},
+        projection={"_id": 0, "user_id": 1, "next_follow_up_at": 1},
+        batch_size=1000
+    )
+
+@_timed
+async def claim_due_follow_up(user_id, worker_id, lease_seconds=300):
+    """Atomically claim a user's due follow-up for this worker
+
+    Returns the onboarding record if the follow-up is due and nobody else holds
+    an unexpired lease on it, otherwise None. The lease is released by
+    advance_follow_up or set_next_follow_up once the send has been handled.
+    """
+    utc = pytz.UTC
+    now = datetime.now(utc)
+    doc = await onboarding.find_one_and_update(
+        {
+            "user_id": str(user_id),
+            "setup_completed": False,
+            "next_follow_up_at": {"$lte": now},
+            "$or": [
+                {"claimed_at": None},
+                {"claimed_at": {"$lte": now - timedelta(seconds=lease_seconds)}}
+            ]
+        },
+        {"$set": {"claimed_by": worker_id, "claimed_at": now}},
+        return_document=ReturnDocument.AFTER
     )
+    if doc:
+        onboarding_cache.update(str(user_id), {"claimed_by": worker_id, "claimed_at": now})
+    return doc
 
-def mark_account_verified(user_id, verified=True):
-    """Mark user's account as verified"""
-    return onboarding.update_one(
+@_timed
+async def advance_follow_up(user_id):
+    """Recompute next_follow_up_at from the sent flags, release the claim and return the new value"""
+    # The sent flags may still be sitting in the write-behind buffer
+    await flush_onboarding_updates()
+    doc = await onboarding.find_one_and_update(
         {"user_id": str(user_id)},
-        {"$set": {"account_verified": verified}}
+        [{"$set": {
+            "next_follow_up_at": _next_follow_up_expr(),
+            "claimed_by": None,
+            "claimed_at": None
+        }}],
+        projection={"next_follow_up_at": 1},
+        return_document=ReturnDocument.AFTER
     )
+    next_at = doc.get("next_follow_up_at") if doc else None
+    onboarding_cache.update(str(user_id), {"next_follow_up_at": next_at, "claimed_by": None, "claimed_at": None})
+    return next_at
 
-def get_users_for_follow_up(follow_up_type, minutes_ago):
-    """Get users who need follow-up messages"""
-    utc = pytz.UTC
-    cutoff_time = datetime.now(utc) - timedelta(minutes=minutes_ago)
-    
-    field = f"follow_up_{follow_up_type}_sent"
-    
-    return onboarding.find({
-        "created_at": {"$lte": cutoff_time},
-        field: False,
-        "setup_completed": False
-    })
+@_timed
+async def set_next_follow_up(user_id, when):
+    """Set when a user's next follow-up is due and release the claim"""
+    fields = {"next_follow_up_at": when, "claimed_by": None, "claimed_at": None}
+    onboarding_cache.update(str(user_id), fields)
+    return await onboarding.update_one({"user_id": str(user_id)}, {"$set": fields})
 
-def is_user_in_onboarding(user_id):
+@_timed
+async def is_user_in_onboarding(user_id):
     """Check if user is in onboarding process"""
-    user = onboarding.find_one({"user_id": str(user_id)})
-    return user is not None
+    return await get_onboarding_user(user_id) is not None
 
-def already_onboarding(user_id):
+@_timed
+async def already_onboarding(user_id):
     """Check if user already has onboarding record"""
-    return onboarding.find_one({"user_id": str(user_id)}) is not None
+    return await get_onboarding_user(user_id) is not None
 
-def reset_onboarding(user_id):
+@_timed
+async def reset_onboarding(user_id):
     """Reset onboarding for a user (delete existing record)"""
-    return onboarding.delete_one({"user_id": str(user_id)})
+    onboarding_writes.discard(user_id)
+    onboarding_cache.set(str(user_id), None)
+    return await onboarding.delete_one({"user_id": str(user_id)})
 
 # Settings functions
-def get_whatsapp_link():
+# All settings documents are held in memory; writers bump the version document
+# so other processes notice the change on their next refresh_settings().
+SETTINGS_VERSION_KEY = "_version"
+settings_cache = tenant_local(dict)
+_settings_version = tenant_local(lambda: {"value": None, "loaded": False})
+
+@_timed
+async def load_settings():
+    """Load every settings document into the cache"""
+    docs = await settings.find({}).to_list(length=None)
+    values = {doc["key"]: doc.get("value") for doc in docs}
+    _settings_version["value"] = values.pop(SETTINGS_VERSION_KEY, None)
+    settings_cache.clear()
+    settings_cache.update(values)
+    _settings_version["loaded"] = True
+    return settings_cache
+
+@_timed
+async def refresh_settings():
+    """Reload the settings cache if another process has changed a setting"""
+    doc = await settings.find_one({"key": SETTINGS_VERSION_KEY})
+    version = doc.get("value") if doc else None
+    if not _settings_version["loaded"] or version != _settings_version["value"]:
+        await load_settings()
+
+@_timed
+async def get_setting(key, default=None):
+    """Get a runtime setting from the cache"""
+    if not _settings_version["loaded"]:
+        await load_settings()
+    return settings_cache.get(key, default)
+
+@_timed
+async def set_setting(key, value):
+    """Store a runtime setting and publish the change to other processes"""
+    await settings.update_one({"key": key}, {"$set": {"value": value}}, upsert=True)
+    doc = await settings.find_one_and_update(
+        {"key": SETTINGS_VERSION_KEY},
+        {"$inc": {"value": 1}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    settings_cache[key] = value
+    _settings_version["value"] = doc["value"]
+
+@_timed
+async def get_whatsapp_link():
     """Get the WhatsApp link from settings"""
-    setting = settings.find_one({"key": "whatsapp_link"})
-    return setting["value"] if setting else None
+    return await get_setting("whatsapp_link")
 
-def set_whatsapp_link(link):
+@_timed
+async def set_whatsapp_link(link):
     """Set the WhatsApp link in settings"""
-    return settings.update_one(
-        {"key": "whatsapp_link"}, 
-        {"$set": {"value": link}}, 
+    return await set_setting("whatsapp_link", link)
+
+# Broadcast job functions
+@_timed
+async def create_broadcast_job(mode, from_chat_id, message_id, admin_chat_id, status_message_id, total):
+    """Persist a new broadcast job and return its document"""
+    utc = pytz.UTC
+    job = {
+        "mode": mode,
+        "from_chat_id": from_chat_id,
+        "message_id": message_id,
+        "admin_chat_id": admin_chat_id,
+        "status_message_id": status_message_id,
+        "status": "running",
+        "cursors": {},
+        "done_shards": [],
+        "total": total,
+        "success": 0,
+        "failed": 0,
+        "blocked": 0,
+        "deactivated": 0,
+        "created_at": datetime.now(utc)
+    }
+    result = await broadcasts.insert_one(job)
+    job["_id"] = result.inserted_id
+    return job
+
+@_timed
+async def get_unfinished_broadcasts():
+    """Get broadcast jobs that were interrupted before completing"""
+    return await broadcasts.find({"status": "running"}).to_list(length=None)
+
+@_timed
+async def get_broadcast_job(job_id):
+    return await broadcasts.find_one({"_id": job_id})
+
+@_timed
+async def get_broadcast_page(shard, after_id, limit, with_first_name=False):
+    """Get the next page of a shard's users after the given _id, in _id order
+
+    With with_first_name, each user's onboarding first_name is joined in the
+    same query so personalised broadcasts don't look users up one by one.
+    """
+    query = {"shard": shard}
+    if after_id is not None:
+        query["_id"] = {"$gt": after_id}
+    if not with_first_name:
+        return await users.find(query, sort=[("_id", ASCENDING)], limit=limit).to_list(length=None)
+
+    return await users.aggregate([
+        {"$match": query},
+        {"$sort": {"_id": 1}},
+        {"$limit": limit},
+        {"$lookup": {
+            "from": "onboarding",
+            "localField": "user_id",
+            "foreignField": "user_id",
+            "as": "onboarding"
+        }},
+        {"$project": {
+            "user_id": 1,
+            "first_name": {"$arrayElemAt": ["$onboarding.first_name", 0]}
+        }}
+    ]).to_list(length=None)
+
+@_timed
+async def get_broadcast_delivered(job_id, user_ids):
+    """Get the user IDs of this page that already have a recorded status"""
+    docs = await broadcast_status.find(
+        {"job_id": job_id, "user_id": {"$in": list(user_ids)}},
+        projection={"user_id": 1}
+    ).to_list(length=None)
+    return {doc["user_id"] for doc in docs}
+
+@_timed
+async def record_broadcast_page(job_id, shard, statuses, cursor, counts):
+    """Store per-user results for a page, add its counts and advance the shard's cursor
+
+    Returns the updated job, whose counts cover every shard.
+    """
+    if statuses:
+        await broadcast_status.insert_many(
+            [{"job_id": job_id, "user_id": user_id, "status": status} for user_id, status in statuses.items()],
+            ordered=False
+        )
+    return await broadcasts.find_one_and_update(
+        {"_id": job_id},
+        {"$set": {f"cursors.{shard}": cursor}, "$inc": counts},
+        return_document=ReturnDocument.AFTER
+    )
+
+@_timed
+async def finish_broadcast_shard(job_id, shard):
+    """Record that a shard of a broadcast job is done and return the updated job"""
+    return await broadcasts.find_one_and_update(
+        {"_id": job_id},
+        {"$addToSet": {"done_shards": shard}},
+        return_document=ReturnDocument.AFTER
+    )
+
+@_timed
+async def finish_broadcast_job(job_id):
+    """Mark a broadcast job as completed (True only for the caller that did it)
+
+    Its per-user statuses are only needed to resume the job, so they are deleted.
+    """
+    utc = pytz.UTC
+    result = await broadcasts.update_one(
+        {"_id": job_id, "status": "running"},
+        {"$set": {"status": "completed", "finished_at": datetime.now(utc)}}
+    )
+    if result.modified_count != 1:
+        return False
+    await broadcast_status.delete_many({"job_id": job_id})
+    return True
+
+# Outbound message queue functions
+@_timed
+async def enqueue_outbox(messages):
+    """Persist outgoing messages for the delivery dispatcher"""
+    if not messages:
+        return
+    return await outbox.insert_many(messages, ordered=False)
+
+@_timed
+async def claim_outbox_message(lease_seconds):
+    """Atomically claim the oldest due message (or one whose sender died)"""
+    utc = pytz.UTC
+    now = datetime.now(utc)
+    return await outbox.find_one_and_update(
+        {"$or": [
+            {"status": "pending", "not_before": {"$lte": now}},
+            {"status": "sending", "claimed_at": {"$lte": now - timedelta(seconds=lease_seconds)}}
+        ]},
+        {"$set": {"status": "sending", "claimed_at": now}},
+        sort=[("not_before", ASCENDING)],
+        return_document=ReturnDocument.AFTER
+    )
+
+@_timed
+async def renew_outbox_lease(message_id):
+    """Extend the lease on a message that is still being sent"""
+    return await outbox.update_one(
+        {"_id": message_id, "status": "sending"},
+        {"$set": {"claimed_at": datetime.now(pytz.UTC)}}
+    )
+
+@_timed
+async def complete_outbox_message(message_id):
+    """Remove a delivered message from the queue"""
+    return await outbox.delete_one({"_id": message_id})
+
+@_timed
+async def retry_outbox_message(message_id, when, error):
+    """Put a failed message back in the queue to be retried at `when`"""
+    return await outbox.update_one(
+        {"_id": message_id},
+        {"$set": {"status": "pending", "not_before": when, "last_error": error}, "$inc": {"attempts": 1}}
+    )
+
+@_timed
+async def dead_letter_outbox_message(message, error):
+    """Move a permanently failed message to the dead-letter collection"""
+    utc = pytz.UTC
+    await dead_letters.replace_one(
+        {"_id": message["_id"]},
+        {**message, "last_error": error, "failed_at": datetime.now(utc)},
+        upsert=True
+    )
+    return await outbox.delete_one({"_id": message["_id"]})
+
+@_timed
+async def outbox_backlog():
+    """Number of messages waiting to be delivered"""
+    return await outbox.count_documents({})
+
+# Shard lease functions
+# Workers heartbeat a "worker:<id>" document and lease "shard:<n>" documents;
+# a lease that is not renewed before expires_at can be taken over.
+@_timed
+async def heartbeat_worker(worker_id, lease_seconds):
+    """Record that a worker is alive and return how many live workers there are"""
+    utc = pytz.UTC
+    now = datetime.now(utc)
+    await shards.update_one(
+        {"_id": f"worker:{worker_id}"},
+        {"$set": {"worker": worker_id, "expires_at": now + timedelta(seconds=lease_seconds)}},
+        upsert=True
+    )
+    return await shards.count_documents({"worker": {"$exists": True}, "expires_at": {"$gt": now}})
+
+@_timed
+async def remove_worker(worker_id):
+    return await shards.delete_one({"_id": f"worker:{worker_id}"})
+
+@_timed
+async def heartbeat_sender(sender_id, lease_seconds):
+    """Record that a process is sending with this bot token and return how many are"""
+    utc = pytz.UTC
+    now = datetime.now(utc)
+    await shards.update_one(
+        {"_id": f"sender:{sender_id}"},
+        {"$set": {"sender": sender_id, "expires_at": now + timedelta(seconds=lease_seconds)}},
         upsert=True
     )
+    return await shards.count_documents({"sender": {"$exists": True}, "expires_at": {"$gt": now}})
+
+@_timed
+async def remove_sender(sender_id):
+    return await shards.delete_one({"_id": f"sender:{sender_id}"})
+
+@_timed
+async def claim_lease(key, owner, lease_seconds, **fields):
+    """Take or renew a named lease in the shards collection; False if someone else holds it"""
+    utc = pytz.UTC
+    now = datetime.now(utc)
+    try:
+        await shards.update_one(
+            {"_id": key, "$or": [{"owner": owner}, {"expires_at": {"$lte": now}}]},
+            {"$set": {**fields, "owner": owner, "expires_at": now + timedelta(seconds=lease_seconds)}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        return False
+    return True
+
+@_timed
+async def release_lease(key, owner):
+    """Give up a lease so someone else can take it straight away"""
+    return await shards.update_one(
+        {"_id": key, "owner": owner},
+        {"$set": {"owner": None, "expires_at": datetime.now(pytz.UTC)}}
+    )
+
+@_timed
+async def claim_shard(shard, worker_id, lease_seconds):
+    """Take or renew the lease on a shard; False if another worker holds it"""
+    return await claim_lease(f"shard:{shard}", worker_id, lease_seconds, shard=shard)
+
+@_timed
+async def release_shard(shard, worker_id):
+    """Give up a shard lease so another worker can take it straight away"""
+    return await release_lease(f"shard:{shard}", worker_id)
+
+@_timed
+async def get_held_shards(worker_id):
+    """Shards currently leased by other workers"""
+    utc = pytz.UTC
+    docs = await shards.find(
+        {"shard": {"$exists": True}, "owner": {"$ne": worker_id}, "expires_at": {"$gt": datetime.now(utc)}},
+        projection={"shard": 1}
+    ).to_list(length=None)
+    return {doc["shard"] for doc in docs}
+
+
+# Pyrogram session storage functions (see session_storage.py)
+@_timed
+async def get_session(name):
+    return await sessions.find_one({"_id": name})
+
+@_timed
+async def update_session(name, fields):
+    return await sessions.update_one({"_id": name}, {"$set": fields}, upsert=True)
+
+@_timed
+async def delete_session(name):
+    return await sessions.delete_one({"_id": name})
+
+@_timed
+async def save_update_states(name, changed, removed):
+    """Store changed update states ({state_id: state}) and drop removed ones in one write"""
+    update = {}
+    if changed:
+        update["$set"] = {f"update_states.{state_id}": state for state_id, state in changed.items()}
+    if removed:
+        update["$unset"] = {f"update_states.{state_id}": "" for state_id in removed}
+    if update:
+        return await sessions.update_one({"_id": name}, update, upsert=True)
+
+@_timed
+async def upsert_peers(peer_rows):
+    """Store (id, access_hash, type, username, phone_number) rows seen by pyrogram"""
+    now = int(time.time())
+    return await peers.bulk_write([
+        UpdateOne(
+            {"_id": peer_id},
+            {"$set": {
+                "access_hash": access_hash,
+                "type": peer_type,
+                "username": username,
+                "phone_number": phone_number,
+                "last_update_on": now
+            }},
+            upsert=True
+        )
+        for peer_id, access_hash, peer_type, username, phone_number in peer_rows
+    ], ordered=False)
+
+@_timed
+async def set_peer_usernames(username_rows):
+    """Store the extra (peer_id, username) pairs of peers with several usernames"""
+    by_peer = {}
+    for peer_id, username in username_rows:
+        by_peer.setdefault(peer_id, []).append(username)
+    return await peers.bulk_write([
+        # Only for peers already stored by upsert_peers; a bare document would lack the access hash
+        UpdateOne({"_id": peer_id}, {"$set": {"usernames": names}})
+        for peer_id, names in by_peer.items()
+    ], ordered=False)
+
+@_timed
+async def find_peer(query):
+    return await peers.find_one({**query, "access_hash": {"$exists": True}})
+
+def get_all_peers():
+    """Every stored peer (async cursor of _id/access_hash/type/username/phone_number/last_update_on)"""
+    return peers.find(
+        {"access_hash": {"$exists": True}},
+        projection={"access_hash": 1, "type": 1, "username": 1, "phone_number": 1, "last_update_on": 1},
+        batch_size=5000
+    )
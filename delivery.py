@@ -0,0 +1,163 @@
+import asyncio
+import logging
+import random
+from datetime import datetime, timedelta
+import pytz
+from pyrogram import errors
+
+from database import (
+    enqueue_outbox, claim_outbox_message, renew_outbox_lease, complete_outbox_message,
+    retry_outbox_message, dead_letter_outbox_message, update_onboarding_stage
+)
+
+logger = logging.getLogger(__name__)
+
+# Failures that retrying will not fix
+PERMANENT_ERRORS = (errors.PeerIdInvalid, errors.UserIsBlocked, errors.InputUserDeactivated)
+
+
+def outbox_message(chat_id, text, delay=0, on_sent_stage=None, on_failed_stage=None, stage_from=None, then=None):
+    """Build an outbox document
+
+    on_sent_stage is written to the user's onboarding record once the message
+    is delivered (on_failed_stage if it is dead-lettered), and `then` (another
+    outbox_message) is queued after it, so a sequence stays in order even when
+    an earlier message has to be retried. With stage_from, the stage is only
+    changed while the record is still at one of those stages, so a message
+    delivered late never moves back a user who has already gone further.
+    """
+    return {
+        "chat_id": int(chat_id),
+        "text": text,
+        "status": "pending",
+        "not_before": datetime.now(pytz.UTC) + timedelta(seconds=delay),
+        "delay": delay,
+        "attempts": 0,
+        "on_sent_stage": on_sent_stage,
+        "on_failed_stage": on_failed_stage,
+        "stage_from": list(stage_from) if stage_from else None,
+        "then": then
+    }
+
+
+class DeliveryQueue:
+    """Durable outbound message queue backed by the outbox collection
+
+    Handlers persist messages and return immediately. A fetcher claims due
+    messages with a lease and hands them to a pool of consumers that send them
+    through the rate limiter. Failed sends are retried with exponential backoff;
+    permanent failures, or messages that exhaust max_attempts, are moved to the
+    dead_letters collection. Messages claimed by a process that died are picked
+    up again once their lease expires; a live process renews the lease until
+    it is done with a message, since FloodWait retries can take longer than
+    lease_seconds.
+    """
+
+    def __init__(self, app, send, workers=20, max_attempts=5, base_delay=5, poll_interval=1, lease_seconds=120):
+        self.app = app
+        self.send = send
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self._queue = asyncio.Queue(maxsize=workers * 2)
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+
+    async def enqueue(self, *messages):
+        """Persist messages and wake the dispatcher"""
+        await enqueue_outbox(list(messages))
+        self._wakeup.set()
+
+    def wake(self):
+        """Check for due messages now (e.g. after another process queued some)"""
+        self._wakeup.set()
+
+    async def start(self):
+        self._tasks = [asyncio.create_task(self._fetch())]
+        self._tasks += [asyncio.create_task(self._consume()) for _ in range(self.workers)]
+        logger.info("Delivery queue started with %s consumers", self.workers)
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        # Messages claimed but not sent go to another process once their lease lapses
+        while not self._queue.empty():
+            _, renewal = self._queue.get_nowait()
+            renewal.cancel()
+
+    async def _fetch(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                message = await claim_outbox_message(self.lease_seconds)
+            except Exception as e:
+                logger.error("Error claiming outbox message: %s", e)
+                message = None
+
+            if message is not None:
+                # Keep the lease while the message waits for a consumer and is sent
+                renewal = asyncio.create_task(self._renew_lease(message))
+                await self._queue.put((message, renewal))
+                continue
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _consume(self):
+        while True:
+            message, renewal = await self._queue.get()
+            try:
+                await self._deliver(message)
+            except Exception as e:
+                logger.error("Error handling outbox message %s: %s", message['_id'], e)
+            finally:
+                renewal.cancel()
+                self._queue.task_done()
+
+    async def _renew_lease(self, message):
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                await renew_outbox_lease(message["_id"])
+            except Exception as e:
+                logger.error("Error renewing lease on outbox message %s: %s", message['_id'], e)
+
+    async def _deliver(self, message):
+        chat_id = message["chat_id"]
+        try:
+            await self.send(self.app.send_message, chat_id, message["text"], disable_web_page_preview=True)
+        except PERMANENT_ERRORS as e:
+            logger.warning("Dropping message to %s: %s", chat_id, e)
+            await self._dead_letter(message, e)
+            return
+        except Exception as e:
+            attempts = message["attempts"] + 1
+            if attempts >= self.max_attempts:
+                logger.error("Giving up on message to %s after %s attempts: %s", chat_id, attempts, e)
+                await self._dead_letter(message, e)
+                return
+            delay = self.base_delay * (2 ** message["attempts"]) + random.uniform(0, 1)
+            if isinstance(e, errors.FloodWait):
+                delay = max(delay, e.value)
+            logger.warning("Send to %s failed (attempt %s/%s): %s. Retrying in %.0fs", chat_id, attempts, self.max_attempts, e, delay)
+            await retry_outbox_message(message["_id"], datetime.now(pytz.UTC) + timedelta(seconds=delay), str(e))
+            return
+
+        if message.get("on_sent_stage"):
+            await update_onboarding_stage(chat_id, message["on_sent_stage"], message.get("stage_from"))
+        if message.get("then"):
+            then = dict(message["then"])
+            then["not_before"] = datetime.now(pytz.UTC) + timedelta(seconds=then.get("delay", 0))
+            await self.enqueue(then)
+        await complete_outbox_message(message["_id"])
+
+    async def _dead_letter(self, message, error):
+        if message.get("on_failed_stage"):
+            await update_onboarding_stage(message["chat_id"], message["on_failed_stage"], message.get("stage_from"))
+        await dead_letter_outbox_message(message, str(error))
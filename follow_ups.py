@@ -0,0 +1,159 @@
+import asyncio
+import heapq
+import logging
+import os
+import socket
+import time
+from datetime import datetime, timedelta
+import pytz
+
+import metrics
+from configs import cfg
+from database import (
+    backfill_next_follow_ups, get_scheduled_follow_ups, claim_due_follow_up,
+    advance_follow_up, set_next_follow_up
+)
+
+logger = logging.getLogger(__name__)
+
+
+def _timestamp(when):
+    """Epoch seconds for a datetime read from Mongo (naive values are UTC)"""
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=pytz.UTC)
+    return when.timestamp()
+
+
+class FollowUpScheduler:
+    """Deliver follow-ups at their due time from an in-memory min-heap
+
+    Each onboarding record carries a next_follow_up_at field. The heap is
+    seeded from one indexed query at startup, new users are pushed as they
+    start onboarding, and the scheduler sleeps until the earliest item is due.
+    Heap entries are only hints: each follow-up is claimed atomically with a
+    lease on the record before sending, so stale or duplicate entries are
+    skipped and several processes can run the scheduler side by side without
+    sending the same follow-up twice.
+
+    Only users in shards leased by this worker are handled. Records created by
+    other processes are found by polling the leased shards every poll_interval
+    seconds, and a shard's backlog is loaded as soon as it is leased.
+    """
+
+    def __init__(self, handlers, leases, batch_size=200, retry_delay=60, lease_seconds=300, poll_interval=30):
+        # handlers maps "1h"/"3h" to a coroutine function taking the onboarding record
+        self.handlers = handlers
+        self.leases = leases
+        self.batch_size = batch_size
+        self.retry_delay = retry_delay
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._heap = []
+        self._queued = set()
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+
+    async def start(self):
+        """Seed the heap from the leased shards and start the delivery loop"""
+        await backfill_next_follow_ups()
+        await self.load_shards(self.leases.owned)
+        self.leases.on_gain(self.load_shards)
+        logger.info("Follow-up scheduler started with %s pending follow-ups", len(self._heap))
+        self._tasks = [asyncio.create_task(self._run()), asyncio.create_task(self._poll())]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def load_shards(self, shard_ids, due_before=None):
+        """Queue the pending follow-ups of the given shards"""
+        if not shard_ids:
+            return
+        async for doc in get_scheduled_follow_ups(shard_ids, due_before):
+            self.schedule(doc["user_id"], _timestamp(doc["next_follow_up_at"]))
+
+    def schedule(self, user_id, due_at):
+        """Queue a user's follow-up for the given epoch time"""
+        if not self.leases.owns_user(user_id):
+            return
+        entry = (due_at, str(user_id))
+        if entry in self._queued:
+            return
+        self._queued.add(entry)
+        heapq.heappush(self._heap, entry)
+        if self._heap[0] == entry:
+            self._wakeup.set()
+
+    def pending(self):
+        return len(self._heap)
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
+
+            delay = self._heap[0][0] - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            now = time.time()
+            due = []
+            while self._heap and self._heap[0][0] <= now and len(due) < self.batch_size:
+                entry = heapq.heappop(self._heap)
+                self._queued.discard(entry)
+                due.append(entry[1])
+
+            try:
+                with metrics.follow_up_batch.time(tenant=cfg.BOT_OWNER):
+                    await asyncio.gather(*[self._process(user_id) for user_id in set(due)])
+            except Exception as e:
+                logger.error("Error processing follow-ups: %s", e)
+
+    async def _poll(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                due_before = datetime.now(pytz.UTC) + timedelta(seconds=self.poll_interval)
+                await self.load_shards(self.leases.owned, due_before)
+            except Exception as e:
+                logger.error("Error polling follow-ups: %s", e)
+
+    async def _process(self, user_id):
+        if not self.leases.owns_user(user_id):
+            # The shard moved to another worker, which will handle it
+            return
+        try:
+            doc = await claim_due_follow_up(user_id, self.worker_id, self.lease_seconds)
+            if not doc:
+                return
+
+            follow_up_type = "3h" if doc.get("follow_up_1h_sent") else "1h"
+            minutes = cfg.FOLLOW_UP_1_MINUTES if follow_up_type == "1h" else cfg.FOLLOW_UP_3_MINUTES
+            due_at = _timestamp(doc["created_at"]) + minutes * 60
+            if due_at > time.time():
+                # next_follow_up_at was ahead of this follow-up's own due time
+                await set_next_follow_up(user_id, datetime.fromtimestamp(due_at, pytz.UTC))
+                self.schedule(user_id, due_at)
+                return
+            await self.handlers[follow_up_type](doc)
+
+            next_at = await advance_follow_up(user_id)
+            if next_at is None:
+                return
+            due_at = _timestamp(next_at)
+            if due_at <= time.time():
+                # The send didn't go through; try again later
+                due_at = time.time() + self.retry_delay
+                await set_next_follow_up(user_id, datetime.now(pytz.UTC) + timedelta(seconds=self.retry_delay))
+            self.schedule(user_id, due_at)
+        except Exception as e:
+            logger.error("Error processing follow-up for %s: %s", user_id, e)
@@ -0,0 +1,64 @@
+import logging
+import random
+import time
+from datetime import datetime
+
+import pytz
+
+from database import get_setting, set_setting
+
+logger = logging.getLogger(__name__)
+
+# Settings key holding the pool: [{"link": ..., "expires": unix time}, ...]
+SETTINGS_KEY = "invite_links"
+
+
+class InviteLinkPool:
+    """A few reusable invite links for the channel, kept in the settings collection
+
+    refresh() runs in the background: it tops the pool up to `size` links and
+    replaces links in the last quarter of their `ttl`, so users are never
+    handed a link about to expire. Replaced links are left to expire on their
+    own, so people who already received one can still use it. Links are
+    created with creates_join_request (join requests are what the bot
+    approves) unless a member_limit is given; Telegram does not allow both.
+    get() only reads the settings cache, which every process keeps up to date.
+    """
+
+    def __init__(self, app, chat_id, size=5, ttl=24 * 60 * 60, member_limit=None):
+        self.app = app
+        self.chat_id = chat_id
+        self.size = size
+        self.ttl = ttl
+        self.member_limit = member_limit
+
+    async def get(self):
+        """A usable invite link from the pool, or None if it is empty"""
+        now = time.time()
+        links = [entry["link"] for entry in await get_setting(SETTINGS_KEY, []) if entry["expires"] > now]
+        return random.choice(links) if links else None
+
+    async def create(self):
+        """Create one link with the pool's settings and return its entry"""
+        expires = int(time.time()) + self.ttl
+        invite = await self.app.create_chat_invite_link(
+            int(self.chat_id),
+            expire_date=datetime.fromtimestamp(expires, pytz.UTC),
+            member_limit=self.member_limit,
+            creates_join_request=None if self.member_limit else True
+        )
+        return {"link": invite.invite_link, "expires": expires}
+
+    async def refresh(self):
+        """Drop links close to expiry and create new ones up to the pool size"""
+        fresh_until = time.time() + self.ttl / 4
+        current = await get_setting(SETTINGS_KEY, [])
+        pool = [entry for entry in current if entry["expires"] > fresh_until]
+        try:
+            while len(pool) < self.size:
+                pool.append(await self.create())
+        finally:
+            # Keep whatever was created even if Telegram refused a later link
+            if pool != current:
+                await set_setting(SETTINGS_KEY, pool)
+                logger.info("Invite link pool refreshed: %s links", len(pool))
@@ -0,0 +1,141 @@
+import atexit
+import json
+import logging
+import queue
+import sys
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+import metrics
+from tenants import current_tenant
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+# Records waiting for the writer thread; more are dropped rather than blocking the event loop
+QUEUE_SIZE = 10000
+
+
+class RateLimitFilter(logging.Filter):
+    """Let at most `limit` records per second through for each message
+
+    Records are keyed by logger and message template, so with %-style
+    arguments every "User %s approved" line shares one budget however many
+    users are approved. The next record let through for a key reports how
+    many were dropped. Warnings and errors are never dropped.
+    """
+
+    MAX_KEYS = 10000
+
+    def __init__(self, limit):
+        super().__init__()
+        self.limit = limit
+        self._windows = {}  # key -> [window start, records let through, records dropped]
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        window = self._windows.get(key)
+        if window is None and len(self._windows) >= self.MAX_KEYS:
+            # Messages logged with f-strings (e.g. by libraries) each get a key; forget idle ones
+            self._windows = {k: w for k, w in self._windows.items() if now - w[0] < 1}
+        if window is None or now - window[0] >= 1:
+            dropped = window[2] if window else 0
+            self._windows[key] = [now, 1, 0]
+            if dropped:
+                record.suppressed = dropped
+            return True
+        if window[1] < self.limit:
+            window[1] += 1
+            return True
+        window[2] += 1
+        return False
+
+
+class TenantFilter(logging.Filter):
+    """Tag records with the bot owner handling them (the writer thread can't see the context)"""
+
+    def filter(self, record):
+        tenant = current_tenant.get(None)
+        record.tenant = tenant.owner if tenant is not None else None
+        return True
+
+
+class LazyQueueHandler(QueueHandler):
+    """QueueHandler that leaves formatting to the writer thread
+
+    The stock handler formats every record before queueing it, on the
+    caller's thread. Here the record is queued as is, so the message is
+    only built from its arguments once it is written. Arguments should not
+    be mutated after the log call.
+    """
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        text = super().format(record)
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            text += f" ({suppressed} similar messages suppressed)"
+        return text
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line"""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "tenant", None):
+            entry["tenant"] = record.tenant
+        if getattr(record, "suppressed", 0):
+            entry["suppressed"] = record.suppressed
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def setup_logging(level="INFO", json_output=False, rate_limit=0):
+    """Send all logging through a queue to a background writer thread
+
+    Log calls on the event loop only filter the record and put it on the
+    queue; formatting and writing to stderr happen in the writer thread,
+    which is flushed when the process exits. rate_limit is the number of
+    records per second let through for each message (0 disables it).
+    """
+    stream = logging.StreamHandler(sys.stderr)
+    stream.setFormatter(JsonFormatter() if json_output else TextFormatter(TEXT_FORMAT))
+
+    handler = LazyQueueHandler(queue.Queue(QUEUE_SIZE))
+    metrics.log_records_dropped.set_function(lambda: handler.dropped)
+    handler.addFilter(TenantFilter())
+    if rate_limit:
+        handler.addFilter(RateLimitFilter(rate_limit))
+
+    root = logging.getLogger()
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    listener = QueueListener(handler.queue, stream)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
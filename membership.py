@@ -0,0 +1,42 @@
+import time
+from collections import OrderedDict
+
+
+class MembershipCache:
+    """Recent answers to "is this user a member of this chat?"
+
+    Positive answers are kept for `ttl` seconds and negative ones for the
+    (shorter) `negative_ttl`, so a user who joins right after being told they
+    are not a member is re-checked soon. Chat IDs are normalised to their
+    negative form, matching both update chat IDs and CHID as configured.
+    """
+
+    def __init__(self, ttl, negative_ttl, maxsize=100000):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    @staticmethod
+    def _key(chat_id, user_id):
+        return -abs(int(chat_id)), int(user_id)
+
+    def get(self, chat_id, user_id):
+        """True/False if known, None if the chat has to be asked"""
+        key = self._key(chat_id, user_id)
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        expires, is_member = entry
+        if expires < time.monotonic():
+            del self._data[key]
+            return None
+        return is_member
+
+    def set(self, chat_id, user_id, is_member):
+        key = self._key(chat_id, user_id)
+        ttl = self.ttl if is_member else self.negative_ttl
+        self._data[key] = (time.monotonic() + ttl, is_member)
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
@@ -0,0 +1,167 @@
+import asyncio
+import inspect
+import logging
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Default histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+FLOOD_WAIT_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+_registry = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(labels.get(name, "") for name in self.labels)
+
+    def _header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+
+
+class Gauge(_Metric):
+    """Gauge set directly or read from a function when scraped"""
+
+    type = "gauge"
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self._values = {}
+        self._functions = {}
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+    def set_function(self, func, **labels):
+        """Read the value from func() (or the coroutine it returns) on every scrape"""
+        self._functions[self._key(labels)] = func
+
+    async def render(self):
+        lines = self._header()
+        values = dict(self._values)
+        for key, func in self._functions.items():
+            try:
+                value = func()
+                if inspect.isawaitable(value):
+                    value = await value
+                values[key] = value
+            except Exception as e:
+                logger.warning("Could not read %s: %s", self.name, e)
+        for key, value in values.items():
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {value}")
+        return lines
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        self._series = {}  # key -> [bucket counts..., sum, count]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the time spent in the with block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    async def render(self):
+        lines = self._header()
+        for key, series in self._series.items():
+            bounds = [str(bound) for bound in self.buckets] + ["+Inf"]
+            counts = series[:len(self.buckets)] + [series[-1]]
+            for bound, count in zip(bounds, counts):
+                le = 'le="' + bound + '"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {count}")
+            labels = _format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {series[-2]}")
+            lines.append(f"{self.name}_count{labels} {series[-1]}")
+        return lines
+
+
+async def render():
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in _registry:
+        lines += await metric.render()
+    return "\n".join(lines) + "\n"
+
+
+async def _handle(reader, writer):
+    try:
+        request = await asyncio.wait_for(reader.readline(), timeout=10)
+        # Skip the request headers
+        while (await asyncio.wait_for(reader.readline(), timeout=10)).strip():
+            pass
+        parts = request.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status, body = "200 OK", (await render()).encode()
+        else:
+            status, body = "404 Not Found", b"Not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except Exception as e:
+        logger.warning("Error serving metrics: %s", e)
+    finally:
+        writer.close()
+
+
+async def serve(host, port):
+    """Serve GET /metrics on host:port; returns the asyncio server"""
+    server = await asyncio.start_server(_handle, host, port)
+    logger.info("Metrics available at http://%s:%s/metrics", host, port)
+    return server
+
+
+# Bot metrics
+handler_latency = Histogram("bot_handler_seconds", "Time spent in update handlers", ["tenant", "handler"])
+send_wait = Histogram("bot_send_wait_seconds", "Time sends waited for the rate limiter", ["tenant"])
+flood_waits = Histogram(
+    "bot_flood_wait_seconds", "FloodWait delays requested by Telegram", ["tenant", "method"], FLOOD_WAIT_BUCKETS
+)
+db_latency = Histogram("bot_db_seconds", "Latency of database.py functions", ["tenant", "function"])
+follow_up_batch = Histogram("bot_follow_up_batch_seconds", "Time to process one batch of due follow-ups", ["tenant"])
+follow_up_backlog = Gauge("bot_follow_up_backlog", "Follow-ups queued in this process's scheduler", ["tenant"])
+outbox_backlog = Gauge("bot_outbox_backlog", "Messages waiting in the outbox", ["tenant"])
+log_records_dropped = Gauge("bot_log_records_dropped", "Log records dropped because the log queue was full")
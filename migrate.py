@@ -0,0 +1,26 @@
+"""One-off database migration: remove duplicate records and make their indexes unique
+
+Run once with the bot's environment (BOT_OWNER, BOT_OWNERS, MONGO_URI, ...)
+if the bot logs that a collection has duplicate values:
+
+    python migrate.py
+"""
+import asyncio
+import logging
+
+from configs import primary_tenant, load_extra_tenants
+from database import migrate_unique_indexes
+from tenants import run_in_tenant
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+async def main():
+    for tenant in [primary_tenant] + load_extra_tenants():
+        logger.info("Migrating tenant %s (DB_NAME: %s)", tenant.owner, tenant.cfg.DB_NAME)
+        await run_in_tenant(tenant, migrate_unique_indexes)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,79 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+    """Async token bucket refilled continuously at `rate` tokens per second"""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def set_rate(self, rate: float, capacity: float = None):
+        """Change the refill rate (and capacity), keeping the tokens already earned"""
+        self._refill()
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self.tokens = min(self.tokens, self.capacity)
+
+    def is_idle(self) -> bool:
+        """True when the bucket is full and nobody is waiting on it"""
+        self._refill()
+        return self.tokens >= self.capacity and not self._lock.locked()
+
+    async def acquire(self):
+        """Wait until a token is available and take it (FIFO across coroutines)"""
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class SendScheduler:
+    """Global token bucket plus one bucket per chat
+
+    Sends to different chats proceed in parallel up to the global rate, while
+    each individual chat is held to its own (much lower) rate.
+    """
+
+    # Drop idle per-chat buckets once this many have accumulated
+    MAX_CHAT_BUCKETS = 10000
+
+    def __init__(self, global_rate: float, per_chat_rate: float, global_burst: float = None, per_chat_burst: float = 1):
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.chat_buckets = {}
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= self.MAX_CHAT_BUCKETS:
+                self._evict_idle()
+            bucket = TokenBucket(self.per_chat_rate, self.per_chat_burst)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _evict_idle(self):
+        for chat_id in [c for c, b in self.chat_buckets.items() if b.is_idle()]:
+            del self.chat_buckets[chat_id]
+
+    def set_global_rate(self, rate: float, burst: float = None):
+        self.global_bucket.set_rate(rate, burst)
+
+    async def acquire(self, chat_id=None):
+        """Wait for both the chat's bucket and the global bucket"""
+        if chat_id is not None:
+            await self._chat_bucket(chat_id).acquire()
+        await self.global_bucket.acquire()
@@ -0,0 +1,252 @@
+import asyncio
+import logging
+import os
+import signal
+import socket
+import time
+
+from pyrogram.storage import Storage
+from pyrogram.storage.sqlite_storage import get_input_peer
+
+from database import (
+    get_session, update_session, delete_session, save_update_states,
+    upsert_peers, set_peer_usernames, find_peer, get_all_peers, claim_lease, release_lease
+)
+
+logger = logging.getLogger(__name__)
+
+SESSION_FIELDS = ("dc_id", "api_id", "test_mode", "auth_key", "date", "user_id", "is_bot")
+
+
+class MongoSessionStorage(Storage):
+    """Pyrogram session storage kept in the tenant's database
+
+    The auth key and other session fields live in one `sessions` document,
+    read once when the client starts and written through when they change.
+    Peers go to the `peers` collection, shared by every session of the bot
+    (access hashes belong to the bot account), so a restarted process or a
+    new worker reconnects without a fresh authorisation and with a warm peer
+    cache.
+
+    The peer table is preloaded into memory on open and kept up to date from
+    the users and chats pyrogram sees in every update, so resolving a peer
+    for a send needs neither an RPC nor a database read. Only new or changed
+    peers are written back; peers stored by another process since the
+    preload are read from the database on first use. Update states (pts)
+    change with almost every update and are written every STATE_SAVE_SECONDS
+    and on save()/close() rather than on the update path; after a crash
+    pyrogram recovers the few updates since the last write with getDifference.
+
+    Each session may only be connected from one process at a time (Telegram
+    rejects a shared auth key with AUTH_KEY_DUPLICATED). With lease_seconds
+    set, open() leases the lowest free slot in the shards collection and uses
+    the session "<name><n>", renewing the lease until close(); background
+    workers use this so any number of them can run, each reusing a session
+    left by an earlier worker instead of logging in again. If the lease
+    can't be renewed in time the process is sent SIGTERM, so it shuts down
+    (and is restarted) instead of sharing the session with its new holder.
+    """
+
+    USERNAME_TTL = 8 * 60 * 60
+    MAX_SLOTS = 100
+    STATE_SAVE_SECONDS = 5
+
+    def __init__(self, name: str, lease_seconds: int = None):
+        super().__init__(name)
+        self.base_name = name
+        self.lease_seconds = lease_seconds
+        self._holder = f"{socket.gethostname()}:{os.getpid()}"
+        self._slot_key = None
+        self._renewal = None
+        self._state_saver = None
+        self._session = {}
+        self._states = {}
+        # Update states changed or removed since they were last written
+        self._changed_states = set()
+        self._removed_states = set()
+        # peer_id -> (access_hash, type, username, phone_number, last_update_on)
+        self._peers = {}
+
+    async def open(self):
+        if self.lease_seconds:
+            await self._claim_slot()
+        doc = await get_session(self.name) or {}
+        self._session = {field: doc.get(field) for field in SESSION_FIELDS}
+        self._states = doc.get("update_states") or {}
+        self._changed_states.clear()
+        self._removed_states.clear()
+        self._state_saver = asyncio.create_task(self._save_states_periodically())
+        self._peers = {}
+        async for peer in get_all_peers():
+            self._remember(peer)
+        logger.info("Loaded %s peers for session %s", len(self._peers), self.name)
+
+    def _remember(self, doc):
+        self._peers[doc["_id"]] = (
+            doc["access_hash"], doc["type"], doc.get("username"), doc.get("phone_number"), doc.get("last_update_on", 0)
+        )
+
+    async def save(self):
+        await self._save_states()
+        await self.date(int(time.time()))
+
+    async def _save_states(self):
+        if not self._changed_states and not self._removed_states:
+            return
+        changed = {state_id: self._states[state_id] for state_id in self._changed_states if state_id in self._states}
+        removed = list(self._removed_states)
+        self._changed_states.clear()
+        self._removed_states.clear()
+        try:
+            await save_update_states(self.name, changed, removed)
+        except Exception:
+            # Write them with the next batch, unless they changed again meanwhile
+            self._changed_states.update(state_id for state_id in changed if state_id not in self._removed_states)
+            self._removed_states.update(state_id for state_id in removed if state_id not in self._changed_states)
+            raise
+
+    async def _save_states_periodically(self):
+        while True:
+            await asyncio.sleep(self.STATE_SAVE_SECONDS)
+            try:
+                await self._save_states()
+            except Exception as e:
+                logger.error("Error saving update states of session %s: %s", self.name, e)
+
+    async def _claim_slot(self):
+        for slot in range(self.MAX_SLOTS):
+            key = f"session:{self.base_name}{slot}"
+            if await claim_lease(key, self._holder, self.lease_seconds):
+                self._slot_key = key
+                self.name = f"{self.base_name}{slot}"
+                self._renewal = asyncio.create_task(self._renew_slot())
+                return
+        raise RuntimeError(f"All {self.MAX_SLOTS} sessions named {self.base_name}<n> are in use")
+
+    async def _renew_slot(self):
+        renewed = time.monotonic()
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                if await claim_lease(self._slot_key, self._holder, self.lease_seconds):
+                    renewed = time.monotonic()
+                    continue
+                logger.critical("Session %s was taken over by another process; shutting down", self.name)
+            except Exception as e:
+                if time.monotonic() - renewed < self.lease_seconds:
+                    logger.error("Error renewing the lease on session %s: %s", self.name, e)
+                    continue
+                logger.critical("Could not renew the lease on session %s in time (%s); shutting down", self.name, e)
+            # Another process may connect with this session now: stop rather than share the auth key
+            os.kill(os.getpid(), signal.SIGTERM)
+            return
+
+    async def close(self):
+        if self._state_saver is not None:
+            self._state_saver.cancel()
+            self._state_saver = None
+            try:
+                await self._save_states()
+            except Exception as e:
+                logger.error("Error saving update states of session %s: %s", self.name, e)
+        if self._renewal is not None:
+            self._renewal.cancel()
+            self._renewal = None
+            await release_lease(self._slot_key, self._holder)
+
+    async def delete(self):
+        await delete_session(self.name)
+        self._session = {}
+        self._states = {}
+        self._changed_states.clear()
+        self._removed_states.clear()
+
+    async def update_peers(self, peers):
+        now = int(time.time())
+        changed = []
+        for row in peers:
+            known = self._peers.get(row[0])
+            # Rewrite unchanged peers now and then so username lookups don't expire
+            if known is None or known[:4] != tuple(row[1:]) or now - known[4] > self.USERNAME_TTL / 2:
+                changed.append(row)
+                self._peers[row[0]] = (*row[1:], now)
+        if not changed:
+            return
+        try:
+            await upsert_peers(changed)
+        except Exception:
+            # Forget them so the next update retries the write
+            for row in changed:
+                self._peers.pop(row[0], None)
+            raise
+
+    async def update_usernames(self, usernames):
+        if usernames:
+            await set_peer_usernames(usernames)
+
+    async def update_state(self, value=object):
+        if value is object:
+            states = [[int(state_id), *state] for state_id, state in self._states.items()]
+            return states or None
+        # Only recorded here; _save_states writes them in the background
+        if isinstance(value, int):
+            state_id = str(value)
+            self._states.pop(state_id, None)
+            self._changed_states.discard(state_id)
+            self._removed_states.add(state_id)
+        else:
+            state_id = str(value[0])
+            self._states[state_id] = list(value[1:])
+            self._removed_states.discard(state_id)
+            self._changed_states.add(state_id)
+
+    async def get_peer_by_id(self, peer_id: int):
+        known = self._peers.get(peer_id)
+        if known is None:
+            doc = await find_peer({"_id": peer_id})
+            if doc is None:
+                raise KeyError(f"ID not found: {peer_id}")
+            self._remember(doc)
+            known = self._peers[peer_id]
+        return get_input_peer(peer_id, known[0], known[1])
+
+    async def get_peer_by_username(self, username: str):
+        doc = await find_peer({"$or": [{"username": username}, {"usernames": username}]})
+        if doc is None:
+            raise KeyError(f"Username not found: {username}")
+        if abs(time.time() - doc["last_update_on"]) > self.USERNAME_TTL:
+            raise KeyError(f"Username expired: {username}")
+        return get_input_peer(doc["_id"], doc["access_hash"], doc["type"])
+
+    async def get_peer_by_phone_number(self, phone_number: str):
+        doc = await find_peer({"phone_number": phone_number})
+        if doc is None:
+            raise KeyError(f"Phone number not found: {phone_number}")
+        return get_input_peer(doc["_id"], doc["access_hash"], doc["type"])
+
+    async def _accessor(self, field, value=object):
+        if value is object:
+            return self._session.get(field)
+        self._session[field] = value
+        await update_session(self.name, {field: value})
+
+    async def dc_id(self, value: int = object):
+        return await self._accessor("dc_id", value)
+
+    async def api_id(self, value: int = object):
+        return await self._accessor("api_id", value)
+
+    async def test_mode(self, value: bool = object):
+        return await self._accessor("test_mode", value)
+
+    async def auth_key(self, value: bytes = object):
+        return await self._accessor("auth_key", value)
+
+    async def date(self, value: int = object):
+        return await self._accessor("date", value)
+
+    async def user_id(self, value: int = object):
+        return await self._accessor("user_id", value)
+
+    async def is_bot(self, value: bool = object):
+        return await self._accessor("is_bot", value)
@@ -0,0 +1,103 @@
+import asyncio
+import logging
+import math
+import os
+import random
+import socket
+
+from database import (
+    shard_of, heartbeat_worker, remove_worker, claim_shard, release_shard, get_held_shards
+)
+
+logger = logging.getLogger(__name__)
+
+
+class ShardLeases:
+    """This worker's share of the background-work shards, leased in Mongo
+
+    Users are split into shard_count shards by user_id. Every running worker
+    heartbeats, takes free or expired shard leases up to its fair share
+    (shard_count / live workers) and releases the excess when more workers
+    join, so follow-ups and broadcasts spread across processes and machines.
+    A worker that dies stops renewing and its shards are taken over once their
+    leases expire.
+    """
+
+    def __init__(self, shard_count, lease_seconds=30):
+        self.shard_count = shard_count
+        self.lease_seconds = lease_seconds
+        self._listeners = []
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.owned = set()
+        self._task = None
+
+    def on_gain(self, callback):
+        """Call `await callback(shards)` whenever new shards are leased"""
+        self._listeners.append(callback)
+
+    def owns(self, shard):
+        return shard in self.owned
+
+    def owns_user(self, user_id):
+        return shard_of(user_id) in self.owned
+
+    async def start(self):
+        await self.rebalance()
+        logger.info("Worker %s leased %s/%s shards", self.worker_id, len(self.owned), self.shard_count)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        for shard in list(self.owned):
+            await release_shard(shard, self.worker_id)
+        self.owned.clear()
+        await remove_worker(self.worker_id)
+
+    async def _run(self):
+        while True:
+            # Renew well before the lease runs out
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                await self.rebalance()
+            except Exception as e:
+                logger.error("Error renewing shard leases: %s", e)
+
+    async def rebalance(self):
+        """Renew held leases, shed shards above the fair share and take free ones up to it"""
+        workers = await heartbeat_worker(self.worker_id, self.lease_seconds)
+        target = math.ceil(self.shard_count / max(workers, 1))
+
+        for shard in list(self.owned):
+            if not await claim_shard(shard, self.worker_id, self.lease_seconds):
+                logger.warning("Lost lease on shard %s", shard)
+                self.owned.discard(shard)
+
+        while len(self.owned) > target:
+            shard = self.owned.pop()
+            await release_shard(shard, self.worker_id)
+
+        gained = set()
+        if len(self.owned) < target:
+            held = await get_held_shards(self.worker_id)
+            free = [s for s in range(self.shard_count) if s not in held and s not in self.owned]
+            # Spread concurrent claimers over different shards
+            random.shuffle(free)
+            for shard in free:
+                if len(self.owned) >= target:
+                    break
+                if await claim_shard(shard, self.worker_id, self.lease_seconds):
+                    self.owned.add(shard)
+                    gained.add(shard)
+
+        if gained:
+            logger.info("Leased shards %s (%s/%s held, %s workers)", sorted(gained), len(self.owned), self.shard_count, workers)
+            for callback in self._listeners:
+                try:
+                    await callback(gained)
+                except Exception as e:
+                    logger.error("Error handling newly leased shards: %s", e)
@@ -0,0 +1,92 @@
+import asyncio
+import contextvars
+
+
+class Tenant:
+    """One bot namespace (BOT_OWNER) served by this process"""
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.owner = cfg.BOT_OWNER
+        self.locals = {}
+
+    def __repr__(self):
+        return f"Tenant({self.owner!r})"
+
+
+# Tenant whose update or background job is being handled. Tasks inherit it from
+# the task that created them, so everything started inside run_in_tenant()
+# (including the tenant's pyrogram dispatcher) sees its own tenant.
+current_tenant = contextvars.ContextVar("current_tenant")
+
+# Tenant used where none has been set (module import, threads, single-tenant mode)
+_default_tenant = None
+
+
+def set_default_tenant(tenant):
+    global _default_tenant
+    _default_tenant = tenant
+
+
+def get_tenant():
+    """The tenant being served in this task"""
+    return current_tenant.get(_default_tenant)
+
+
+class TenantProxy:
+    """Forwards attribute and item access to an object of the current tenant"""
+
+    __slots__ = ("_resolve",)
+
+    def __init__(self, resolve):
+        object.__setattr__(self, "_resolve", resolve)
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._resolve(), name, value)
+
+    def __getitem__(self, key):
+        return self._resolve()[key]
+
+    def __setitem__(self, key, value):
+        self._resolve()[key] = value
+
+    def __contains__(self, key):
+        return key in self._resolve()
+
+    def __iter__(self):
+        return iter(self._resolve())
+
+    def __len__(self):
+        return len(self._resolve())
+
+    def __repr__(self):
+        return f"TenantProxy({self._resolve()!r})"
+
+
+def tenant_local(factory):
+    """Proxy to an object built once per tenant by factory()
+
+    The factory runs inside the tenant's context on first use, so it can read
+    that tenant's configuration through cfg.
+    """
+    key = object()
+
+    def resolve():
+        tenant = get_tenant()
+        if key not in tenant.locals:
+            tenant.locals[key] = factory()
+        return tenant.locals[key]
+
+    return TenantProxy(resolve)
+
+
+async def run_in_tenant(tenant, func, *args):
+    """Await func(*args) in a task bound to the given tenant"""
+    async def runner():
+        current_tenant.set(tenant)
+        return await func(*args)
+
+    return await asyncio.create_task(runner())
@@ -0,0 +1,38 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+# configs validates these at import time; nothing here talks to Telegram or Mongo
+os.environ.setdefault("API_ID", "1")
+os.environ.setdefault("API_HASH", "test")
+os.environ.setdefault("BOT_TOKEN", "1:test")
+os.environ.setdefault("CHID", "-1001")
+os.environ.setdefault("SUDO", "1")
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017")
+os.chdir(ROOT)
+
+
+class FakeClock:
+    """Stands in for the `time` module of the code under test"""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
@@ -0,0 +1,136 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+
+import pytz
+
+import follow_ups
+from configs import cfg
+from follow_ups import FollowUpScheduler
+
+
+class FakeLeases:
+    def __init__(self, users):
+        self.users = set(users)
+        self.owned = {0}
+
+    def owns_user(self, user_id):
+        return int(user_id) in self.users
+
+
+class FakeDatabase:
+    """The database functions FollowUpScheduler uses, over a dict of onboarding records"""
+
+    def __init__(self, monkeypatch, records):
+        self.records = records
+        self.claimed = []
+        self.next_set = {}
+        for name in ("claim_due_follow_up", "advance_follow_up", "set_next_follow_up", "get_scheduled_follow_ups"):
+            monkeypatch.setattr(follow_ups, name, getattr(self, name))
+
+    async def claim_due_follow_up(self, user_id, worker_id, lease_seconds):
+        self.claimed.append(user_id)
+        return self.records.pop(user_id, None)
+
+    async def advance_follow_up(self, user_id):
+        return None
+
+    async def set_next_follow_up(self, user_id, when):
+        self.next_set[user_id] = when
+
+    async def get_scheduled_follow_ups(self, shard_ids, due_before=None):
+        for user_id, when in [("5", datetime(2030, 1, 1)), ("6", datetime(2030, 1, 2, tzinfo=pytz.UTC))]:
+            yield {"user_id": user_id, "next_follow_up_at": when}
+
+
+def record(user_id, minutes_ago, **fields):
+    return {"user_id": user_id, "created_at": datetime.now(pytz.UTC) - timedelta(minutes=minutes_ago), **fields}
+
+
+def scheduler_for(users, handlers=None):
+    return FollowUpScheduler(handlers or {}, FakeLeases(users), retry_delay=60)
+
+
+def test_schedule_keeps_the_earliest_first_and_skips_duplicates():
+    async def main():
+        scheduler = scheduler_for([1, 2, 3])
+        scheduler.schedule(1, 300)
+        scheduler.schedule(2, 100)
+        scheduler.schedule(2, 100)
+        scheduler.schedule(3, 200)
+        scheduler.schedule(4, 50)  # another worker's shard
+        return scheduler._heap[0], scheduler.pending()
+
+    assert asyncio.run(main()) == ((100, "2"), 3)
+
+
+def test_load_shards_queues_scheduled_follow_ups(monkeypatch):
+    FakeDatabase(monkeypatch, {})
+
+    async def main():
+        scheduler = scheduler_for([5, 6])
+        await scheduler.load_shards({0})
+        return sorted(scheduler._heap)
+
+    assert asyncio.run(main()) == [
+        (datetime(2030, 1, 1, tzinfo=pytz.UTC).timestamp(), "5"),
+        (datetime(2030, 1, 2, tzinfo=pytz.UTC).timestamp(), "6"),
+    ]
+
+
+def test_due_follow_ups_are_sent(monkeypatch):
+    database = FakeDatabase(monkeypatch, {"1": record("1", cfg.FOLLOW_UP_1_MINUTES + 1)})
+    sent = []
+
+    async def send_1h(doc):
+        sent.append(doc["user_id"])
+
+    async def main():
+        scheduler = scheduler_for([1], {"1h": send_1h})
+        task = asyncio.create_task(scheduler._run())
+        scheduler.schedule(1, time.time() - 1)
+        await asyncio.sleep(0.05)
+        task.cancel()
+        return scheduler.pending()
+
+    assert asyncio.run(main()) == 0
+    assert sent == ["1"]
+    assert database.claimed == ["1"]
+
+
+def test_follow_up_claimed_elsewhere_is_skipped(monkeypatch):
+    database = FakeDatabase(monkeypatch, {})
+    sent = []
+
+    async def send_1h(doc):
+        sent.append(doc)
+
+    asyncio.run(scheduler_for([1], {"1h": send_1h})._process("1"))
+    assert database.claimed == ["1"]
+    assert sent == []
+
+
+def test_follow_up_before_its_own_due_time_is_rescheduled(monkeypatch):
+    # next_follow_up_at said the 3h follow-up was due, but it is only an hour since they joined
+    database = FakeDatabase(monkeypatch, {"1": record("1", 60, follow_up_1h_sent=True)})
+    sent = []
+
+    async def send_3h(doc):
+        sent.append(doc)
+
+    async def main():
+        scheduler = scheduler_for([1], {"3h": send_3h})
+        await scheduler._process("1")
+        return scheduler._heap
+
+    heap = asyncio.run(main())
+    assert sent == []
+    due_at = database.next_set["1"].timestamp()
+    assert heap == [(due_at, "1")]
+    assert abs(due_at - (time.time() + (cfg.FOLLOW_UP_3_MINUTES - 60) * 60)) < 5
+
+
+def test_users_in_a_lost_shard_are_left_to_their_new_owner(monkeypatch):
+    database = FakeDatabase(monkeypatch, {"1": record("1", 500)})
+    asyncio.run(scheduler_for([])._process("1"))
+    assert database.claimed == []
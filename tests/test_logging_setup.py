@@ -0,0 +1,46 @@
+import logging
+
+import logging_setup
+from logging_setup import RateLimitFilter
+
+
+def record(msg, level=logging.INFO, name="bot"):
+    return logging.LogRecord(name, level, __file__, 1, msg, (1,), None)
+
+
+def test_records_over_the_limit_are_dropped_and_counted(monkeypatch, clock):
+    monkeypatch.setattr(logging_setup, "time", clock)
+    limiter = RateLimitFilter(limit=2)
+    results = [limiter.filter(record("User %s approved")) for _ in range(5)]
+    assert results == [True, True, False, False, False]
+
+    clock.advance(1)
+    next_record = record("User %s approved")
+    assert limiter.filter(next_record)
+    assert next_record.suppressed == 3
+
+
+def test_each_message_and_logger_has_its_own_budget(monkeypatch, clock):
+    monkeypatch.setattr(logging_setup, "time", clock)
+    limiter = RateLimitFilter(limit=1)
+    assert limiter.filter(record("User %s approved"))
+    assert limiter.filter(record("User %s blocked"))
+    assert limiter.filter(record("User %s approved", name="delivery"))
+    assert not limiter.filter(record("User %s approved"))
+
+
+def test_warnings_are_never_dropped(monkeypatch, clock):
+    monkeypatch.setattr(logging_setup, "time", clock)
+    limiter = RateLimitFilter(limit=1)
+    assert all(limiter.filter(record("Retrying %s", logging.WARNING)) for _ in range(10))
+
+
+def test_idle_keys_are_forgotten_when_full(monkeypatch, clock):
+    monkeypatch.setattr(logging_setup, "time", clock)
+    monkeypatch.setattr(RateLimitFilter, "MAX_KEYS", 3)
+    limiter = RateLimitFilter(limit=1)
+    for i in range(3):
+        limiter.filter(record(f"message {i}"))
+    clock.advance(2)
+    limiter.filter(record("fresh"))
+    assert set(limiter._windows) == {("bot", "fresh")}
@@ -0,0 +1,38 @@
+import membership
+from membership import MembershipCache
+
+
+def test_unknown_user_needs_a_check():
+    assert MembershipCache(ttl=60, negative_ttl=5).get(-1001, 42) is None
+
+
+def test_chat_ids_are_normalised():
+    cache = MembershipCache(ttl=60, negative_ttl=5)
+    cache.set(1001, 42, True)
+    assert cache.get(-1001, 42) is True
+    assert cache.get("1001", "42") is True
+
+
+def test_negative_answers_expire_sooner(monkeypatch, clock):
+    monkeypatch.setattr(membership, "time", clock)
+    cache = MembershipCache(ttl=60, negative_ttl=5)
+    cache.set(-1001, 1, True)
+    cache.set(-1001, 2, False)
+
+    clock.advance(6)
+    assert cache.get(-1001, 1) is True
+    assert cache.get(-1001, 2) is None
+
+    clock.advance(60)
+    assert cache.get(-1001, 1) is None
+
+
+def test_least_recently_set_entry_is_evicted():
+    cache = MembershipCache(ttl=60, negative_ttl=5, maxsize=2)
+    cache.set(-1001, 1, True)
+    cache.set(-1001, 2, True)
+    cache.set(-1001, 1, False)
+    cache.set(-1001, 3, True)
+    assert cache.get(-1001, 2) is None
+    assert cache.get(-1001, 1) is False
+    assert cache.get(-1001, 3) is True
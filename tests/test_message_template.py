@@ -0,0 +1,30 @@
+import pytest
+
+from configs import MessageTemplate
+
+
+def test_static_values_are_filled_in_at_load_time():
+    template = MessageTemplate("t", "Join {channel} now, {first_name}!", {"channel": "@news"}, ["first_name"])
+    assert template.parts == ["Join @news now, ", ("first_name", None, ""), "!"]
+    assert template.render(first_name="Ann") == "Join @news now, Ann!"
+
+
+def test_render_applies_conversion_and_format_spec():
+    template = MessageTemplate("t", "{first_name!r:>8}|{count:03}", {"count": 7}, ["first_name"])
+    assert template.render(first_name="Bo") == "    'Bo'|007"
+
+
+def test_template_without_placeholders():
+    template = MessageTemplate("t", "Hello {{literal}}", {}, [])
+    assert template.parts == ["Hello {literal}"]
+    assert template.render() == "Hello {literal}"
+
+
+def test_unknown_placeholder_is_rejected():
+    with pytest.raises(ValueError, match="unknown placeholder {whatsapp_link}"):
+        MessageTemplate("welcome_message", "Hi {whatsapp_link}", {"channel": "x"}, ["first_name"])
+
+
+def test_malformed_template_is_rejected():
+    with pytest.raises(ValueError, match="malformed"):
+        MessageTemplate("t", "Hi {first_name", {}, ["first_name"])
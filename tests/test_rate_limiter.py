@@ -0,0 +1,74 @@
+import asyncio
+import time
+
+import rate_limiter
+from rate_limiter import TokenBucket, SendScheduler
+
+
+def test_bucket_starts_full_and_refills(monkeypatch, clock):
+    monkeypatch.setattr(rate_limiter, "time", clock)
+    bucket = TokenBucket(rate=2, capacity=4)
+    assert bucket.tokens == 4
+
+    bucket.tokens = 0
+    clock.advance(1)
+    bucket._refill()
+    assert bucket.tokens == 2
+
+    clock.advance(10)
+    bucket._refill()
+    assert bucket.tokens == 4
+
+
+def test_default_capacity_is_at_least_one():
+    assert TokenBucket(rate=0.5).capacity == 1
+    assert TokenBucket(rate=30).capacity == 30
+
+
+def test_set_rate_keeps_earned_tokens_up_to_new_capacity(monkeypatch, clock):
+    monkeypatch.setattr(rate_limiter, "time", clock)
+    bucket = TokenBucket(rate=10, capacity=10)
+    bucket.tokens = 3
+    clock.advance(0.5)
+    bucket.set_rate(5, 20)
+    assert (bucket.rate, bucket.capacity, bucket.tokens) == (5, 20, 8)
+
+    bucket.set_rate(1, 2)
+    assert bucket.tokens == 2
+
+
+def test_is_idle(monkeypatch, clock):
+    monkeypatch.setattr(rate_limiter, "time", clock)
+    bucket = TokenBucket(rate=1, capacity=1)
+    assert bucket.is_idle()
+    bucket.tokens = 0
+    assert not bucket.is_idle()
+    clock.advance(1)
+    assert bucket.is_idle()
+
+
+def test_acquire_waits_for_tokens():
+    async def main():
+        bucket = TokenBucket(rate=50, capacity=1)
+        start = time.monotonic()
+        for _ in range(3):
+            await bucket.acquire()
+        return time.monotonic() - start
+
+    # The first token is there already, the other two take 1/50s each
+    assert asyncio.run(main()) >= 0.035
+
+
+def test_scheduler_evicts_idle_chat_buckets(monkeypatch):
+    monkeypatch.setattr(SendScheduler, "MAX_CHAT_BUCKETS", 2)
+
+    async def main():
+        scheduler = SendScheduler(global_rate=1000, per_chat_rate=0.001, per_chat_burst=5)
+        await scheduler.acquire(1)
+        await scheduler.acquire(2)
+        scheduler.chat_buckets[1].tokens = scheduler.chat_buckets[1].capacity
+        await scheduler.acquire(3)
+        return set(scheduler.chat_buckets)
+
+    # Chat 2's bucket was still refilling, so only chat 1 was dropped
+    assert asyncio.run(main()) == {2, 3}
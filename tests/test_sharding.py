@@ -0,0 +1,86 @@
+import asyncio
+
+import sharding
+from sharding import ShardLeases
+
+
+class FakeLeaseTable:
+    """Shard leases as {shard: owner} in place of the shards collection"""
+
+    def __init__(self, monkeypatch, workers=1, held=None):
+        self.workers = workers
+        self.held = dict(held or {})
+        for name in ("heartbeat_worker", "claim_shard", "release_shard", "get_held_shards"):
+            monkeypatch.setattr(sharding, name, getattr(self, name))
+
+    async def heartbeat_worker(self, worker_id, lease_seconds):
+        return self.workers
+
+    async def claim_shard(self, shard, worker_id, lease_seconds):
+        if self.held.get(shard, worker_id) != worker_id:
+            return False
+        self.held[shard] = worker_id
+        return True
+
+    async def release_shard(self, shard, worker_id):
+        if self.held.get(shard) == worker_id:
+            del self.held[shard]
+
+    async def get_held_shards(self, worker_id):
+        return {shard for shard, owner in self.held.items() if owner != worker_id}
+
+
+def test_single_worker_leases_every_free_shard(monkeypatch):
+    FakeLeaseTable(monkeypatch, held={3: "other"})
+    gained = []
+
+    async def on_gain(shards):
+        gained.append(shards)
+
+    async def main():
+        leases = ShardLeases(shard_count=4)
+        leases.on_gain(on_gain)
+        await leases.rebalance()
+        await leases.rebalance()
+        return leases.owned
+
+    assert asyncio.run(main()) == {0, 1, 2}
+    assert gained == [{0, 1, 2}]
+
+
+def test_shards_above_the_fair_share_are_released(monkeypatch):
+    table = FakeLeaseTable(monkeypatch)
+
+    async def main():
+        leases = ShardLeases(shard_count=4)
+        await leases.rebalance()
+        table.workers = 2
+        await leases.rebalance()
+        return leases.owned
+
+    owned = asyncio.run(main())
+    assert len(owned) == 2
+    assert set(table.held) == owned
+
+
+def test_lost_shard_is_dropped_and_a_free_one_taken(monkeypatch):
+    table = FakeLeaseTable(monkeypatch, workers=2)
+    gained = []
+
+    async def on_gain(shards):
+        gained.append(shards)
+
+    async def main():
+        leases = ShardLeases(shard_count=4)
+        leases.on_gain(on_gain)
+        await leases.rebalance()
+        # Another worker took over one of our shards after our lease lapsed
+        lost = min(leases.owned)
+        table.held[lost] = "other"
+        await leases.rebalance()
+        return lost, leases.owned
+
+    lost, owned = asyncio.run(main())
+    assert lost not in owned
+    assert len(owned) == 2
+    assert len(gained) == 2 and len(gained[1]) == 1
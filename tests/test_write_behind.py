@@ -0,0 +1,94 @@
+import asyncio
+
+import pytest
+
+from database import _WriteBehindBuffer
+
+
+class FakeCollection:
+    """Records bulk_write batches as {user_id: fields}; `gate` holds the next write until set"""
+
+    def __init__(self):
+        self.batches = []
+        self.gate = None
+        self.started = asyncio.Event()
+        self.fail = False
+
+    async def bulk_write(self, ops, ordered=True):
+        self.started.set()
+        gate, self.gate = self.gate, None
+        if gate is not None:
+            await gate.wait()
+        if self.fail:
+            raise ConnectionError("down")
+        self.batches.append({op._filter["user_id"]: op._doc["$set"] for op in ops})
+
+
+def test_updates_in_one_interval_are_merged():
+    async def main():
+        collection = FakeCollection()
+        buffer = _WriteBehindBuffer(collection, interval=0.01)
+        buffer.set(1, {"a": 1})
+        buffer.set(1, {"b": 2})
+        buffer.set(2, {"a": 3})
+        await asyncio.sleep(0.05)
+        return collection.batches
+
+    assert asyncio.run(main()) == [{"1": {"a": 1, "b": 2}, "2": {"a": 3}}]
+
+
+def test_overlay_and_discard():
+    async def main():
+        buffer = _WriteBehindBuffer(FakeCollection(), interval=60)
+        buffer.set(1, {"onboarding_stage": "completed"})
+        doc = buffer.overlay({"user_id": "1", "onboarding_stage": "welcome_sent", "first_name": "Ann"})
+        buffer.discard(1)
+        return doc, buffer.overlay({"user_id": "1", "onboarding_stage": "welcome_sent"})
+
+    doc, after_discard = asyncio.run(main())
+    assert doc == {"user_id": "1", "onboarding_stage": "completed", "first_name": "Ann"}
+    assert after_discard["onboarding_stage"] == "welcome_sent"
+
+
+def test_flush_waits_for_a_write_already_in_flight():
+    async def main():
+        collection = FakeCollection()
+        gate = collection.gate = asyncio.Event()
+        buffer = _WriteBehindBuffer(collection, interval=60)
+        buffer.set(1, {"follow_up_1h_sent": True})
+        first = asyncio.create_task(buffer.flush())
+        await collection.started.wait()
+
+        # The first batch is being written; a second flush must not return before it lands
+        buffer.set(2, {"follow_up_1h_sent": True})
+        second = asyncio.create_task(buffer.flush())
+        await asyncio.sleep(0.01)
+        assert not second.done()
+        assert collection.batches == []
+
+        gate.set()
+        await asyncio.gather(first, second)
+        return collection.batches
+
+    assert asyncio.run(main()) == [{"1": {"follow_up_1h_sent": True}}, {"2": {"follow_up_1h_sent": True}}]
+
+
+def test_failed_write_keeps_updates_without_overriding_newer_ones():
+    async def main():
+        collection = FakeCollection()
+        gate = collection.gate = asyncio.Event()
+        collection.fail = True
+        buffer = _WriteBehindBuffer(collection, interval=60)
+        buffer.set(1, {"onboarding_stage": "welcome_sent", "setup_completed": False})
+        flush = asyncio.create_task(buffer.flush())
+        await collection.started.wait()
+        buffer.set(1, {"onboarding_stage": "completed"})
+        gate.set()
+        with pytest.raises(ConnectionError):
+            await flush
+
+        collection.fail = False
+        await buffer.flush()
+        return collection.batches
+
+    assert asyncio.run(main()) == [{"1": {"onboarding_stage": "completed", "setup_completed": False}}]
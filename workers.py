@@ -0,0 +1,90 @@
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import os
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerPool:
+    """Background worker processes and the local queues that feed them
+
+    Each process is spawned fresh and re-imports the bot with
+    WORKER_ROLE=worker, so it has its own Client session and event loop and
+    runs the delivery queue, follow-ups, broadcasts and bulk approvals while
+    the parent keeps handling updates. The parent talks to them over one
+    multiprocessing queue per process: notify() sends an event to every
+    worker (wake-ups and hints, which each worker applies to its own shards),
+    submit() hands a job to a single worker.
+    """
+
+    def __init__(self, target, count):
+        # target(queue) is the worker entry point; it must be importable from the main module
+        self.target = target
+        self.count = count
+        self._context = multiprocessing.get_context("spawn")
+        self._processes = [None] * count
+        self._queues = [None] * count
+        self._next = itertools.count()
+
+    def start(self):
+        for index in range(self.count):
+            self._spawn(index)
+        logger.info("Started %s background worker processes", self.count)
+
+    def _spawn(self, index):
+        queue = self._context.Queue()
+        process = self._context.Process(target=self.target, args=(queue,), name=f"worker-{index}", daemon=True)
+        # The child reads its role and index from the environment when it imports the bot
+        overrides = {"WORKER_ROLE": "worker", "WORKER_INDEX": str(index)}
+        previous = {name: os.environ.get(name) for name in overrides}
+        os.environ.update(overrides)
+        try:
+            process.start()
+        finally:
+            for name, value in previous.items():
+                if value is None:
+                    del os.environ[name]
+                else:
+                    os.environ[name] = value
+        self._processes[index] = process
+        self._queues[index] = queue
+
+    async def supervise(self):
+        """Restart worker processes that have died"""
+        for index, process in enumerate(self._processes):
+            if process is not None and not process.is_alive():
+                logger.error("Worker process %s exited with code %s; restarting it", process.name, process.exitcode)
+                self._spawn(index)
+
+    def notify(self, tenant, event, **data):
+        """Send an event to every worker"""
+        for queue in self._queues:
+            queue.put((tenant, event, data))
+
+    def submit(self, tenant, event, **data):
+        """Hand a job to one worker (round robin)"""
+        self._queues[next(self._next) % self.count].put((tenant, event, data))
+
+    def stop(self, timeout=30):
+        for queue in self._queues:
+            queue.put(None)
+        for process in self._processes:
+            process.join(timeout)
+            if process.is_alive():
+                logger.warning("Worker process %s did not stop in time; terminating it", process.name)
+                process.terminate()
+
+
+async def consume(queue, handle):
+    """Call `await handle(tenant, event, data)` for every message on a worker's queue until it is closed"""
+    loop = asyncio.get_running_loop()
+    while True:
+        message = await loop.run_in_executor(None, queue.get)
+        if message is None:
+            return
+        try:
+            await handle(*message)
+        except Exception as e:
+            logger.error("Error handling worker event %s: %s", message[1], e)